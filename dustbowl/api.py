@@ -59,9 +59,23 @@ class ExtensionPoint(property):
     def extensions(self, component):
         """Return a list of components that declare to implement the extension
         point interface.
+
+        The resolved list is cached on the component manager and reused until
+        either a new component class is registered or a component is enabled
+        or disabled.
         """
+        compmgr = component.compmgr
+        generation = (ComponentMeta._generation, compmgr._generation)
+        cached = compmgr._extensions.get(self.interface)
+        if cached is not None and cached[0] == generation:
+            return list(cached[1])
         classes = ComponentMeta._registry.get(self.interface, [])
-        return filter(None, [component.compmgr[cls] for cls in classes])
+        extensions = filter(None, [compmgr[cls] for cls in classes])
+        # Activating a component may itself have changed the generation, in
+        # which case the list is recomputed on the next access.
+        if generation == (ComponentMeta._generation, compmgr._generation):
+            compmgr._extensions[self.interface] = (generation, extensions)
+        return list(extensions)
 
     def __repr__(self):
         """Return a textual representation of the extension point."""
@@ -73,8 +87,9 @@ class ComponentMeta(type):
 
     Takes care of component and extension point registration.
     """
-    _components = []
+    _components = set()
     _registry = {}
+    _generation = 0
 
     def __new__(cls, name, bases, d):
         """Create the component class."""
@@ -113,13 +128,19 @@ class ComponentMeta(type):
             # Don't put abstract component classes in the registry
             return new_class
 
-        ComponentMeta._components.append(new_class)
+        ComponentMeta._components.add(new_class)
         registry = ComponentMeta._registry
-        for interface in d.get('_implements', []):
-            registry.setdefault(interface, []).append(new_class)
+        interfaces = list(d.get('_implements', []))
         for base in [base for base in bases if hasattr(base, '_implements')]:
-            for interface in base._implements:
+            interfaces.extend(base._implements)
+        # A class may list an interface more than once (directly and through
+        # its bases) but is only registered once per interface.
+        seen = set()
+        for interface in interfaces:
+            if interface not in seen:
+                seen.add(interface)
                 registry.setdefault(interface, []).append(new_class)
+        ComponentMeta._generation += 1
 
         return new_class
 
@@ -178,6 +199,8 @@ class ComponentManager(object):
         """Initialize the component manager."""
         self.components = {}
         self.enabled = {}
+        self._extensions = {}
+        self._generation = 0
         if isinstance(self, Component):
             self.components[self.__class__] = self
 
@@ -213,6 +236,20 @@ class ComponentManager(object):
             component = component.__class__
         self.enabled[component] = False
         self.components[component] = None
+        self._generation += 1
+
+    def enable_component(self, component):
+        """Force a component to be enabled.
+
+        The argument `component` can be a class or an instance.  The component
+        will be activated the next time it is requested.
+        """
+        if not isinstance(component, type):
+            component = component.__class__
+        self.enabled[component] = True
+        if self.components.get(component, False) is None:
+            del self.components[component]
+        self._generation += 1
 
     def component_activated(self, component):
         """Can be overridden by sub-classes so that special initialization for
@@ -230,11 +267,23 @@ class ComponentManager(object):
 
 
 class IShellCommandProvider(Interface):
+    def get_command_prefixes(self):
+        """ Return an iterable of the command names owned by the provider.
+
+        A provider owning ``log`` is handed ``log`` as well as every command
+        below it, such as ``log.show.all``.  This method is optional;
+        providers that do not implement it are consulted via `match()`.
+        """
+
     def match(self, cmd):
         """ Returns True if the provider handles the provided command.  False otherwise. """
 
     def run(self, cmd, *args, **kwargs):
-        """ Invokes the given command """
+        """ Invokes the given command
+
+        May return a coroutine, made with the `dustbowl.loop.coroutine`
+        decorator, to be run by the event loop of the console.
+        """
 
 
 class IShellConsoleObjectProvider(Interface):
@@ -20,23 +20,53 @@
 
 # Standard Library Imports
 import os
-from ConfigParser import ConfigParser
+import stat
+import marshal
+import time
+import tempfile
+import threading
+import weakref
+from contextlib import contextmanager
+from functools import wraps
+from ConfigParser import ConfigParser, Error as ConfigParserError
 
 # Third Party Imports
 
 # Local imports
 from util import to_unicode
 from error import ConfigurationError
-from api import ExtensionPoint
+from api import ExtensionPoint, Interface, ComponentMeta
 
 __all__ = ['Configuration', 'Option', 'BoolOption', 'IntOption', 'ListOption',
            'PathOption', 'ExtensionOption', 'OrderedExtensionsOption',
-           'ConfigurationError']
+           'ConfigurationError', 'ConfigurationWatcher',
+           'IConfigurationChangeListener']
 
 _TRUE_VALUES = ('yes', 'true', 'enabled', 'on', 'aye', '1', 1, True)
 
 CRLF = '\r\n'
 
+# Bumped whenever the layout of the snapshot files changes
+SNAPSHOT_VERSION = 2
+
+
+def _get_mtime(path):
+    """Return the modification time of `path`, or ``None`` if it is
+    missing."""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class IConfigurationChangeListener(Interface):
+    def config_changed(self, changes):
+        """ Called after the configuration has been reloaded.
+
+        `changes` is a set of `(section, option)` tuples naming the options
+        that were added, removed or modified.
+        """
+
 
 class Configuration(object):
     """Thin layer over `ConfigParser` from the Python standard library.
@@ -44,8 +74,23 @@ class Configuration(object):
     In addition to providing some convenience methods, the class remembers
     the last modification time of the configuration file, and reparses it
     when the file has changed.
+
+    A configuration inherits the options it does not set itself from the file
+    named by the `file` option of the `[inherit]` section, and from the
+    `*.ini` fragments found in the comma-separated directories of the `dirs`
+    option.  The directories are read in the listed order and the fragments
+    of each directory in sorted order.  Every fragment overrides the ones read
+    before it and the inherited file, and is itself overridden by the file
+    listing the directories.  Fragments are parsed independently, so only the
+    changed ones are reparsed; an `[inherit]` section in a fragment is
+    ignored.
+
+    If `snapshot` is true, the parsed configuration, including the files it
+    inherits from, is also saved in a compiled form next to the file.  The
+    snapshot is loaded instead of parsing the files for as long as none of
+    them change.
     """
-    def __init__(self, filename):
+    def __init__(self, filename, snapshot=False, inherit=True):
         self.filename = filename
         if filename and isinstance(filename, basestring):
             d = {'here': os.path.dirname(filename)}
@@ -53,9 +98,33 @@ class Configuration(object):
             d = {'here': os.getcwd()}
         self.parser = ConfigParser(d)
         self.parent = None
+        # Whether the `[inherit]` section is honoured.  It is not for the
+        # fragments, which are linked into `parent` by the file listing them.
+        self._inherit = inherit
+        # The configuration of `[inherit] file` and the fragments of
+        # `[inherit] dirs`, lowest precedence first
+        self._inherited = None
+        self._fragments = []
+        # `(dirname, mtime)` of each fragment directory when it was listed
+        self._fragment_dirs = []
         self._lastmtime = 0
         self._sections = {}
-        self.parse_if_needed()
+        # Bumped whenever the parsed values change, so that consumers can
+        # cheaply tell whether data derived from the configuration is stale
+        self._generation = 0
+        # Converted values returned by the `Section` getters
+        self._cache = {}
+        self._cache_token = None
+        # The inheritance chain flattened by `_get_merged()`
+        self._merged = None
+        self._snapshot_path = None
+        if snapshot and filename and isinstance(filename, basestring):
+            self._snapshot_path = filename + '.snapshot'
+        # Nesting depth of `batch()` and whether it has changes to write
+        self._batch_depth = 0
+        self._batch_dirty = False
+        if not (self._snapshot_path and self._load_snapshot()):
+            self.parse_if_needed()
 
     def __contains__(self, name):
         """Return whether the configuration contains a section of the given
@@ -138,29 +207,48 @@ class Configuration(object):
         """Remove the specified option."""
         if self.parser.has_section(section):
             self.parser.remove_option(section, name)
+            self._generation += 1
+            self._changed()
+
+    def _changed(self):
+        """Record that a batch has changes to write."""
+        if self._batch_depth:
+            self._batch_dirty = True
+
+    @contextmanager
+    def batch(self):
+        """Group changes so that the file is written at most once.
+
+        Calls to `set()`, `remove()` and `save()` made within the block only
+        mark the configuration as changed, and the file is saved when the
+        outermost batch ends.  Nothing is written if the block raises an
+        exception; the changes remain in memory.
+        """
+        self._batch_depth += 1
+        completed = False
+        try:
+            yield self
+            completed = True
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                dirty = self._batch_dirty
+                self._batch_dirty = False
+                if completed and dirty:
+                    self.save()
 
     def sections(self):
         """Return a list of section names."""
-        sections = set(self.parser.sections())
-        parent = self.parent
-        while parent:
-            sections |= set(parent.parser.sections())
-            parent = parent.parent
-        return sorted(sections)
+        return sorted(self._get_merged())
 
     def has_option(self, section, option):
         """Returns True if option exists in section in either project or
         parent trac.ini, or available through the Option registry.
         """
-        # Check config
-        for file_option, val in self.options(section):
-            if file_option == option:
-                return True
-        # Check inherited ini
-        if self.parent:
-            for parent_option, val in self.parent.options(section):
-                if parent_option == option:
-                    return True
+        # Check config and inherited ini
+        options = self._get_merged().get(section)
+        if options and option in options[1]:
+            return True
         # Check the registry
         if (section, option) in Option.registry:
             return True
@@ -168,10 +256,59 @@ class Configuration(object):
         return False
 
     def save(self):
-        """Write the configuration options to the primary file."""
+        """Write the configuration options to the primary file.
+
+        The file is replaced atomically, by writing to a temporary file and
+        renaming it, and is left untouched if its content would not change.
+        Within a `batch()` the file is only written when the batch ends.
+        """
         if not self.filename:
             return
+        if self._batch_depth:
+            self._batch_dirty = True
+            return
 
+        content = self._serialize()
+        try:
+            fileobj = open(self.filename, 'rb')
+            try:
+                if fileobj.read() == content:
+                    return
+            finally:
+                fileobj.close()
+        except IOError:
+            pass
+
+        dirname, basename = os.path.split(os.path.abspath(self.filename))
+        fd, tmpname = tempfile.mkstemp(prefix='.%s.' % basename, suffix='.tmp',
+                                       dir=dirname)
+        try:
+            fileobj = os.fdopen(fd, 'wb')
+            try:
+                fileobj.write(content)
+                fileobj.flush()
+                os.fsync(fileobj.fileno())
+            finally:
+                fileobj.close()
+            # mkstemp() creates the file readable by its owner only, so give
+            # it the mode of the file it replaces, or the default one
+            if os.path.exists(self.filename):
+                os.chmod(tmpname, stat.S_IMODE(os.stat(self.filename).st_mode))
+                if os.name == 'nt':
+                    # rename() does not replace existing files on Windows
+                    os.remove(self.filename)
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(tmpname, 0666 & ~umask)
+            os.rename(tmpname, self.filename)
+        except:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+
+    def _serialize(self):
+        """Return the content written by `save()` as an encoded string."""
         # Only save options that differ from the defaults
         sections = []
         for section in self.sections():
@@ -187,20 +324,143 @@ class Configuration(object):
             if options:
                 sections.append((section, sorted(options)))
 
-        fileobj = open(self.filename, 'w')
+        lines = ['# -*- coding: utf-8 -*-\n\n']
+        for section, options in sections:
+            lines.append('[%s]\n' % section)
+            for key, val in options:
+                if key in self[section].overridden:
+                    lines.append('# %s = <inherited>\n' % key)
+                else:
+                    val = val.replace(CRLF, '\n').replace('\n', '\n ')
+                    lines.append('%s = %s\n' % (key, val.encode('utf-8')))
+            lines.append('\n')
+        return ''.join(lines)
+
+    def _chain_token(self):
+        """Return the generations of this configuration and of every
+        configuration it inherits from."""
+        token = []
+        config = self
+        while config:
+            token.append(config._generation)
+            config = config.parent
+        return token
+
+    def _get_merged(self):
+        """Return the inheritance chain flattened into a single dictionary.
+
+        The dictionary maps each section name to a `(names, values)` tuple.
+        `names` lists the options of the section, those of this file first,
+        and `values` maps each option name to a `(value, config)` tuple where
+        `config` is the `Configuration` the value was read from.  The result
+        is rebuilt only after a change to a file of the chain.
+        """
+        token = self._chain_token()
+        merged = self._merged
+        if merged is None or merged[0] != token:
+            merged = self._merged = (token, self._flatten())
+        return merged[1]
+
+    def _flatten(self):
+        parent_merged = {}
+        if self.parent:
+            parent_merged = self.parent._get_merged()
+        merged = dict(parent_merged)
+        parser = self.parser
+        for section in parser.sections():
+            names = []
+            values = {}
+            for name in parser.options(section):
+                try:
+                    value = parser.get(section, name)
+                except ConfigParserError, e:
+                    # Raised when the value is read, as ConfigParser would
+                    value = e
+                names.append(name)
+                values[name] = (value, self)
+            if section in parent_merged:
+                parent_names, parent_values = parent_merged[section]
+                for name in parent_names:
+                    if name not in values:
+                        names.append(name)
+                        values[name] = parent_values[name]
+            merged[section] = (names, values)
+        return merged
+
+    def _lookup(self, section, name):
+        """Return the `(value, config)` tuple of an option, or ``None`` if it
+        is not set in any file of the inheritance chain."""
+        options = self._get_merged().get(section)
+        if options is None:
+            return None
+        return options[1].get(self.parser.optionxform(name))
+
+    def get_source(self, section, name):
+        """Return the name of the file the value of an option was read from,
+        or ``None`` if it is not set in any file."""
+        entry = self._lookup(section, name)
+        return entry and entry[1].filename or None
+
+    def _get_cached(self, key, func):
+        """Return the value cached under `key`, calling `func` to compute it
+        if needed.
+
+        The cache is dropped whenever this configuration or one it inherits
+        from is changed or reparsed, and whenever an `Option` is created, as
+        unset options fall back on the default of the registered one.
+        """
+        token = self._chain_token()
+        token.append(Option._generation)
+        if token != self._cache_token:
+            self._cache = {}
+            self._cache_token = token
         try:
-            fileobj.write('# -*- coding: utf-8 -*-\n\n')
-            for section, options in sections:
-                fileobj.write('[%s]\n' % section)
-                for key, val in options:
-                    if key in self[section].overridden:
-                        fileobj.write('# %s = <inherited>\n' % key)
-                    else:
-                        val = val.replace(CRLF, '\n').replace('\n', '\n ')
-                        fileobj.write('%s = %s\n' % (key, val.encode('utf-8')))
-                fileobj.write('\n')
-        finally:
-            fileobj.close()
+            value = self._cache[key]
+        except KeyError:
+            value = self._cache[key] = func()
+        except TypeError:
+            # Unhashable arguments, such as a list default
+            return func()
+        if isinstance(value, list):
+            return list(value)
+        return value
+
+    def get_file_stamps(self):
+        """Return `(filename, mtime, size)` tuples for the file of this
+        configuration and each file it inherits from.
+
+        This only uses `os.stat`, so it is cheap enough to be polled.
+        """
+        stamps = []
+        config = self
+        while config and config.filename:
+            try:
+                st = os.stat(config.filename)
+                stamps.append((config.filename, st.st_mtime, st.st_size))
+            except OSError:
+                stamps.append((config.filename, None, None))
+            # Adding or removing a fragment changes the directory
+            for dirname, mtime in config._fragment_dirs:
+                stamps.append((dirname, _get_mtime(dirname), None))
+            config = config.parent
+        return stamps
+
+    def snapshot(self):
+        """Return a dictionary of every option value keyed by
+        `(section, option)`, including inherited options.
+
+        The values are the raw ones, as read from the files.  A value that
+        can not be interpolated is given as the name and message of the
+        error raised when reading it, so that taking a snapshot never fails.
+        """
+        values = {}
+        for section, (names, options) in self._get_merged().iteritems():
+            for name in names:
+                value = options[name][0]
+                if isinstance(value, ConfigParserError):
+                    value = (value.__class__.__name__, str(value))
+                values[(section, name)] = value
+        return values
 
     def parse_if_needed(self):
         if not self.filename or not os.path.isfile(self.filename):
@@ -210,27 +470,241 @@ class Configuration(object):
         modtime = os.path.getmtime(self.filename)
         if modtime > self._lastmtime:
 #            self._replace_here_var(self.filename)
-            self.parser._sections = {}
-            self.parser.read(self.filename)
+            # Parse into a new parser and swap it in, so that readers in other
+            # threads never see a partially read file
+            parser = ConfigParser(self.parser.defaults())
+            parser.read(self.filename)
+            self.parser = parser
             self._lastmtime = modtime
             changed = True
 
+        if self._inherit:
+            changed |= self._update_chain()
+
+        if changed:
+            self._generation += 1
+            if self._snapshot_path:
+                self._write_snapshot()
+        return changed
+
+    def _update_chain(self):
+        """Link the inherited file and the fragments into the chain of
+        parents, reparsing those that changed.
+
+        Returns whether anything in the chain changed.
+        """
+        changed = False
+        inherited = self._inherited
         if self.parser.has_option('inherit', 'file'):
-            filename = self.parser.get('inherit', 'file')
-            if not os.path.isabs(filename):
-                filename = os.path.join(os.path.dirname(self.filename),
-                                        filename)
-            if not self.parent or self.parent.filename != filename:
-                self.parent = Configuration(filename)
+            filename = self._inherit_path(self.parser.get('inherit', 'file'))
+            if not inherited or inherited.filename != filename:
+                inherited = Configuration(filename)
                 changed = True
             else:
-                changed |= self.parent.parse_if_needed()
-        elif self.parent:
+                changed |= inherited.parse_if_needed()
+        elif inherited:
             changed = True
-            self.parent = None
-
+            inherited = None
+        self._inherited = inherited
+
+        dirs = []
+        if self.parser.has_option('inherit', 'dirs'):
+            value = self.parser.get('inherit', 'dirs')
+            for dirname in value.split(','):
+                dirname = dirname.strip()
+                if dirname:
+                    dirname = os.path.normpath(self._inherit_path(dirname))
+                    if dirname not in dirs:
+                        dirs.append(dirname)
+        previous = dict((fragment.filename, fragment)
+                        for fragment in self._fragments)
+        fragment_dirs = []
+        fragments = []
+        seen = set()
+        for dirname in dirs:
+            # Stat before listing, so that a fragment added meanwhile is
+            # noticed on the next check
+            fragment_dirs.append((dirname, _get_mtime(dirname)))
+            try:
+                names = sorted(os.listdir(dirname))
+            except OSError:
+                continue
+            for name in names:
+                filename = os.path.join(dirname, name)
+                if name.startswith('.') or not name.endswith('.ini') or \
+                   filename in seen or not os.path.isfile(filename):
+                    continue
+                seen.add(filename)
+                fragment = previous.get(filename)
+                if fragment is None:
+                    fragment = Configuration(filename, inherit=False)
+                else:
+                    changed |= fragment.parse_if_needed()
+                fragments.append(fragment)
+        if fragments != self._fragments:
+            changed = True
+        self._fragments = fragments
+        self._fragment_dirs = fragment_dirs
+
+        parent = inherited
+        for fragment in fragments:
+            if fragment.parent is not parent:
+                fragment.parent = parent
+                # Invalidate what the fragment merged from its old parents
+                fragment._generation += 1
+            parent = fragment
+        self.parent = parent
         return changed
 
+    def _inherit_path(self, filename):
+        """Return `filename` relative to the directory of this file."""
+        if not os.path.isabs(filename):
+            filename = os.path.join(os.path.dirname(self.filename), filename)
+        return filename
+
+    def _load_snapshot(self):
+        """Restore this configuration and the ones it inherits from from the
+        snapshot file.
+
+        Returns False, leaving the configuration untouched, if there is no
+        usable snapshot or if any of the files changed since it was written.
+        """
+        try:
+            fileobj = open(self._snapshot_path, 'rb')
+            try:
+                data = marshal.load(fileobj)
+            finally:
+                fileobj.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+        if not isinstance(data, dict) or \
+           data.get('version') != SNAPSHOT_VERSION or \
+           data.get('filename') != self.filename:
+            return False
+        for filename, mtime, size in data['files']:
+            try:
+                st = os.stat(filename)
+            except OSError:
+                return False
+            if st.st_mtime != mtime or st.st_size != size:
+                return False
+        for inherit, fragment_dirs in data['chain']:
+            for dirname, mtime in fragment_dirs:
+                if _get_mtime(dirname) != mtime:
+                    return False
+
+        configs = []
+        config = self
+        for (filename, mtime, size), sections, (inherit, fragment_dirs) in \
+                zip(data['files'], data['parsers'], data['chain']):
+            if config is None:
+                config = Configuration(None, inherit=inherit)
+                config.filename = filename
+                configs[-1].parent = config
+            config._fragment_dirs = [tuple(entry) for entry in fragment_dirs]
+            parser = ConfigParser({'here': os.path.dirname(filename)})
+            dict_type = parser._dict
+            for section, options in sections:
+                options.insert(0, ('__name__', section))
+                parser._sections[section] = dict_type(options)
+            config.parser = parser
+            config._lastmtime = mtime
+            config._generation += 1
+            configs.append(config)
+            config = None
+
+        # Recover the inherited file and the fragments of each configuration
+        # honouring `[inherit]`; its fragments follow it in the chain
+        for idx, config in enumerate(configs):
+            if not config._inherit:
+                continue
+            pos = idx + 1
+            while pos < len(configs) and not configs[pos]._inherit:
+                pos += 1
+            config._fragments = configs[pos - 1:idx:-1]
+            config._inherited = pos < len(configs) and configs[pos] or None
+
+        merged = {}
+        for section, options in data['merged'].iteritems():
+            names = []
+            values = {}
+            for name, value, idx in options:
+                names.append(name)
+                values[name] = (value, configs[idx])
+            merged[section] = (names, values)
+        self._merged = (self._chain_token(), merged)
+        return True
+
+    def _write_snapshot(self):
+        """Save this configuration and the ones it inherits from to the
+        snapshot file."""
+        files = []
+        parsers = []
+        chain = []
+        configs = []
+        config = self
+        while config:
+            try:
+                st = os.stat(config.filename)
+            except OSError:
+                return
+            if st.st_mtime != config._lastmtime:
+                # Changed since it was parsed; wait for the next reparse
+                return
+            for dirname, mtime in config._fragment_dirs:
+                if _get_mtime(dirname) != mtime:
+                    return
+            files.append((config.filename, st.st_mtime, st.st_size))
+            chain.append((config._inherit, config._fragment_dirs))
+            sections = []
+            for section in config.parser.sections():
+                options = [(name, value) for name, value
+                           in config.parser._sections[section].iteritems()
+                           if name != '__name__']
+                sections.append((section, options))
+            parsers.append(sections)
+            configs.append(config)
+            config = config.parent
+
+        merged = {}
+        for section, (names, values) in self._get_merged().iteritems():
+            options = []
+            for name in names:
+                value, source = values[name]
+                if isinstance(value, ConfigParserError):
+                    # Keep reporting the error from the parser instead
+                    return
+                options.append((name, value, configs.index(source)))
+            merged[section] = options
+
+        data = {
+            'version' : SNAPSHOT_VERSION,
+            'filename' : self.filename,
+            'files' : files,
+            'parsers' : parsers,
+            'chain' : chain,
+            'merged' : merged,
+        }
+        dirname, basename = os.path.split(os.path.abspath(self._snapshot_path))
+        try:
+            fd, tmpname = tempfile.mkstemp(prefix='.%s.' % basename,
+                                           suffix='.tmp', dir=dirname)
+        except (IOError, OSError):
+            return
+        try:
+            fileobj = os.fdopen(fd, 'wb')
+            try:
+                marshal.dump(data, fileobj, 2)
+            finally:
+                fileobj.close()
+            if os.name == 'nt' and os.path.exists(self._snapshot_path):
+                os.remove(self._snapshot_path)
+            os.rename(tmpname, self._snapshot_path)
+        except (IOError, OSError, ValueError):
+            # The snapshot is only an optimization
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+
     def _replace_here_var(self, filename):
         dirname = os.path.dirname(filename)
         f = file(filename, 'rb').read().replace(r'%(here)s', dirname)
@@ -243,6 +717,18 @@ class Configuration(object):
             os.utime(self.filename, None)
 
 
+def _cached(getter):
+    """Make a `Section` getter store its converted values in the value cache
+    of the configuration."""
+    @wraps(getter)
+    def cached_getter(self, name, *args, **kwargs):
+        key = (self.name, name, getter.__name__, args,
+               tuple(sorted(kwargs.items())))
+        return self.config._get_cached(key, lambda: getter(self, name, *args,
+                                                           **kwargs))
+    return cached_getter
+
+
 class Section(object):
     """Proxy for a specific configuration section.
 
@@ -256,35 +742,28 @@ class Section(object):
         self.overridden = {}
 
     def __contains__(self, name):
-        if self.config.parser.has_option(self.name, name):
-            return True
-        if self.config.parent:
-            return name in self.config.parent[self.name]
-        return False
+        return self.config._lookup(self.name, name) is not None
 
     def __iter__(self):
-        options = set()
-        if self.config.parser.has_section(self.name):
-            for option in self.config.parser.options(self.name):
-                options.add(option.lower())
+        options = self.config._get_merged().get(self.name)
+        if options:
+            for option in options[0]:
                 yield option
-        if self.config.parent:
-            for option in self.config.parent[self.name]:
-                if option.lower() not in options:
-                    yield option
 
     def __repr__(self):
         return '<Section [%s]>' % self.name
 
+    @_cached
     def get(self, name, default=''):
         """Return the value of the specified option.
 
         Valid default input is a string. Returns a string.
         """
-        if self.config.parser.has_option(self.name, name):
-            value = self.config.parser.get(self.name, name)
-        elif self.config.parent:
-            value = self.config.parent[self.name].get(name, default)
+        entry = self.config._lookup(self.name, name)
+        if entry is not None:
+            value = entry[0]
+            if isinstance(value, ConfigParserError):
+                raise value
         else:
             option = Option.registry.get((self.name, name))
             if option:
@@ -298,6 +777,7 @@ class Section(object):
         else:
             return value
 
+    @_cached
     def getbool(self, name, default=''):
         """Return the value of the specified option as boolean.
 
@@ -311,6 +791,7 @@ class Section(object):
             value = value.lower() in _TRUE_VALUES
         return bool(value)
 
+    @_cached
     def getint(self, name, default=''):
         """Return the value of the specified option as integer.
 
@@ -328,6 +809,7 @@ class Section(object):
             raise ConfigurationError('[%s] %s: expected integer, got %s' %
                                      (self.name, name, repr(value)))
 
+    @_cached
     def getlist(self, name, default='', sep=',', keep_empty=True):
         """Return a list of values that have been specified as a single
         comma-separated option.
@@ -349,24 +831,24 @@ class Section(object):
             items = filter(None, items)
         return items
 
+    @_cached
     def getpath(self, name, default=''):
         """Return the value of the specified option as a path name, relative to
         the location of the configuration file the option is defined in.
 
         Valid default input is a string. Returns a string with normalised path.
         """
-        if self.config.parser.has_option(self.name, name):
-            path = self.config.parser.get(self.name, name)
-            if not path:
-                return default
-            if not os.path.isabs(path):
-                path = os.path.join(os.path.dirname(self.config.filename),
-                                    path)
-            return os.path.normcase(os.path.realpath(path))
-        elif self.config.parent:
-            return self.config.parent[self.name].getpath(name, default)
-        else:
+        entry = self.config._lookup(self.name, name)
+        if entry is None:
+            return default
+        path, config = entry
+        if isinstance(path, ConfigParserError):
+            raise path
+        if not path:
             return default
+        if not os.path.isabs(path):
+            path = os.path.join(os.path.dirname(config.filename), path)
+        return os.path.normcase(os.path.realpath(path))
 
     def options(self):
         """Return `(name, value)` tuples for every option in the section."""
@@ -385,13 +867,19 @@ class Section(object):
             value = ''
         else:
             value = to_unicode(value).encode('utf-8')
-        return self.config.parser.set(self.name, name, value)
+        self.config.parser.set(self.name, name, value)
+        # Bumped after the change so that a concurrent reader can not cache
+        # the old value under the new generation
+        self.config._generation += 1
+        self.config._changed()
 
 
 class Option(object):
     """Descriptor for configuration options on `Configurable` subclasses."""
 
     registry = {}
+    # Bumped whenever an option is registered
+    _generation = 0
     accessor = Section.get
 
     def __init__(self, section, name, default=None, doc=''):
@@ -407,6 +895,7 @@ class Option(object):
         self.name = name
         self.default = default
         self.registry[(self.section, self.name)] = self
+        Option._generation += 1
         self.__doc__ = doc
 
     #noinspection PyArgumentList
@@ -457,19 +946,40 @@ class PathOption(Option):
     accessor = Section.getpath
 
 
+def _extensions_key(instance):
+    """Return what the components resolved by an extension option of
+    `instance` depend on: the configuration and the component registry."""
+    config = getattr(instance, 'config', None)
+    token = isinstance(config, Configuration) and \
+            tuple(config._chain_token()) or ()
+    compmgr = getattr(instance, 'compmgr', None)
+    return (token, ComponentMeta._generation,
+            getattr(compmgr, '_generation', None))
+
+
 class ExtensionOption(Option):
 
     def __init__(self, section, name, interface, default=None, doc=''):
         Option.__init__(self, section, name, default, doc)
         self.xtnpt = ExtensionPoint(interface)
+        # Resolved implementation per instance
+        self._cache = weakref.WeakKeyDictionary()
 
     def __get__(self, instance, owner):
         if instance is None:
             return self
+        key = _extensions_key(instance)
+        cached = self._cache.get(instance)
+        if cached is not None and cached[0] == key:
+            return cached[1]
         value = Option.__get__(self, instance, owner)
+        index = {}
         for impl in self.xtnpt.extensions(instance):
-            if impl.__class__.__name__ == value:
-                return impl
+            index.setdefault(impl.__class__.__name__, impl)
+        impl = index.get(value)
+        if impl is not None:
+            self._cache[instance] = (key, impl)
+            return impl
         raise AttributeError('Cannot find an implementation of the "%s" '
                              'interface named "%s".  Please update the option '
                              '%s.%s in trac.ini.'
@@ -489,22 +999,113 @@ class OrderedExtensionsOption(ListOption):
         ListOption.__init__(self, section, name, default, doc=doc)
         self.xtnpt = ExtensionPoint(interface)
         self.include_missing = include_missing
+        # Resolved, ordered components per instance
+        self._cache = weakref.WeakKeyDictionary()
 
     def __get__(self, instance, owner):
         if instance is None:
             return self
+        key = _extensions_key(instance)
+        cached = self._cache.get(instance)
+        if cached is not None and cached[0] == key:
+            return list(cached[1])
         order = ListOption.__get__(self, instance, owner)
+        position = {}
+        for idx, name in enumerate(order):
+            position.setdefault(name, idx)
         components = []
         for impl in self.xtnpt.extensions(instance):
-            if self.include_missing or impl.__class__.__name__ in order:
+            if self.include_missing or impl.__class__.__name__ in position:
                 components.append(impl)
 
-        def compare(x, y):
-            x, y = x.__class__.__name__, y.__class__.__name__
-            if x not in order:
-                return int(y in order)
-            if y not in order:
-                return -int(x in order)
-            return cmp(order.index(x), order.index(y))
-        components.sort(compare)
-        return components
+        # Components named in the option come first, in that order.  The
+        # sort is stable, so the others keep their registration order.
+        def sort_key(impl):
+            idx = position.get(impl.__class__.__name__)
+            if idx is None:
+                return (1, 0)
+            return (0, idx)
+        components.sort(key=sort_key)
+        self._cache[instance] = (key, components)
+        return list(components)
+
+
+class ConfigurationWatcher(object):
+    """Polls the files of a configuration, and the files it inherits from, for
+    changes from a background thread.
+
+    Polling only stats the files.  Once they have changed and then stayed the
+    same for `debounce` seconds, the configuration is reparsed and `callback`
+    is called with the set of changed `(section, option)` tuples.
+    """
+
+    def __init__(self, config, callback, interval=2.0, debounce=0.5,
+                 log=None):
+        self.config = config
+        self.callback = callback
+        self.interval = interval
+        self.debounce = debounce
+        self.log = log
+        self._stamps = config.get_file_stamps()
+        self._changed_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start polling from a daemon thread."""
+        if self._thread and self._thread.isAlive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='dustbowl-config-watcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop polling."""
+        self._stop.set()
+        if self._thread and self._thread is not threading.currentThread():
+            self._thread.join()
+        self._thread = None
+
+    #noinspection PyBroadException
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except:
+                if self.log:
+                    self.log.error('Error while reloading the configuration',
+                                   exc_info=True)
+
+    def check(self):
+        """Reload the configuration if its files changed and have since been
+        left alone for `debounce` seconds.
+
+        Returns the set of changed `(section, option)` tuples, or ``None`` if
+        the configuration was not reloaded.
+        """
+        stamps = self.config.get_file_stamps()
+        now = time.time()
+        if stamps != self._stamps:
+            self._stamps = stamps
+            self._changed_at = now
+            return None
+        if self._changed_at is None or now - self._changed_at < self.debounce:
+            return None
+
+        before = self.config.snapshot()
+        changed = self.config.parse_if_needed()
+        # Only forget about the change once the files were reparsed, so that
+        # a failed reload is tried again
+        self._changed_at = None
+        if not changed:
+            return None
+        # Reparsing may have switched to another parent file
+        self._stamps = self.config.get_file_stamps()
+        after = self.config.snapshot()
+        changes = set(key for key in set(before) | set(after)
+                      if before.get(key) != after.get(key))
+        if changes:
+            self.callback(changes)
+        return changes
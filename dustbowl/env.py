@@ -22,26 +22,43 @@
 
 # Standard Library imports
 import sys
+import os
 import os.path
-import inspect
+import logging
+import operator
+import threading
+import cPickle as pickle
 
 # Third Party imports
 import pkg_resources
 from pkg_resources import DistributionNotFound, VersionConflict, UnknownExtra
 
 # Local imports
-from api import Component, ComponentManager, Interface, IShellCommandProvider
+from api import Component, ComponentManager, ComponentMeta, Interface
+from api import IShellCommandProvider
 from api import ExtensionPoint, IShellConsoleObjectProvider, DustbowlObj
 from error import ConsoleObjectError
-from config import Configuration
+from config import Configuration, ConfigurationWatcher, BoolOption, IntOption
+from config import IConfigurationChangeListener
 from log import NullLogger
+from loop import Coroutine
+from profiling import NullProfiler
 from util import format_exception
 
 __all__ = [
     'Environment',
     'IEnvObjectProvider',
+    'DeferredObject',
 ]
 
+# Entry point groups in which a module can declare what it provides so that
+# importing it can be deferred until first use
+DEFERRED_GROUPS = {
+    'commands' : 'dustbowl.commands',
+    'console_objects' : 'dustbowl.console_objects',
+    'env_objects' : 'dustbowl.env_objects',
+}
+
 
 class IEnvObjectProvider(Interface):
     def get_console_objects(self):
@@ -51,15 +68,254 @@ class IEnvObjectProvider(Interface):
         """
 
 
+def _get_caller_name(frame):
+    """ Return the name of the function, and class, running in `frame` """
+    caller_class = ''
+    if 'self' in frame.f_locals:
+        caller_class = frame.f_locals['self'].__class__.__name__
+    return "%s%s" % (caller_class and (caller_class + '.') or '',
+                     frame.f_code.co_name)
+
+
+def _get_mtime(path):
+    """ Return the modification time of `path`, or ``None`` if it is missing """
+    try:
+        return os.stat(path or os.curdir).st_mtime
+    except OSError:
+        return None
+
+
+class EnablementMatcher(object):
+    """Compiled form of the plugin data and the ``[components]`` section.
+
+    Plugin names are indexed by their dotted parts and the ``[components]``
+    options by character, so that a lookup costs no more than the length of
+    the name being checked.  Results are memoized per name.
+    """
+
+    def __init__(self, plugin_data, config):
+        # The generations of the whole chain of files, as [components] may
+        # be set in an inherited file or a fragment
+        self.generation = config._chain_token()
+        self.plugins = {}
+        for key, data in plugin_data.iteritems():
+            node = self.plugins
+            for part in key.split('.'):
+                node = node.setdefault(part, {})
+            node[None] = data
+
+        # Options are stored as (position, enabled) tuples so that, as
+        # before, the first matching option in the section wins.
+        self.exact = {}
+        self.wildcards = {}
+        for idx, (key, value) in enumerate(config.options('components')):
+            k = key.lower()
+            match = (idx, config.getbool('components', key))
+            self.exact.setdefault(k, match)
+            if k.endswith('*'):
+                node = self.wildcards
+                for char in k[:-1]:
+                    node = node.setdefault(char, {})
+                node.setdefault(None, match)
+
+        self._plugin_cache = {}
+        self._module_cache = {}
+
+    def find_plugin(self, component_name):
+        """Return the plugin data of the module providing the component."""
+        try:
+            return self._plugin_cache[component_name]
+        except KeyError:
+            pass
+        node = self.plugins
+        data = None
+        for part in component_name.split('.'):
+            node = node.get(part)
+            if node is None:
+                break
+            data = node.get(None, data)
+        self._plugin_cache[component_name] = data
+        return data
+
+    def is_module_enabled(self, module_name):
+        """Return whether the module is enabled in ``[components]``."""
+        try:
+            return self._module_cache[module_name]
+        except KeyError:
+            pass
+        mod = module_name.lower()
+        best = self.exact.get(mod)
+        node = self.wildcards
+        pos = 0
+        while node is not None:
+            match = node.get(None)
+            if match is not None and (best is None or match < best):
+                best = match
+            if pos == len(mod):
+                break
+            node = node.get(mod[pos])
+            pos += 1
+        enabled = best is not None and best[1]
+        self._module_cache[module_name] = enabled
+        return enabled
+
+
+def _forward(operation, reflected=False):
+    """ Return a `DeferredObject` method applying `operation` to the real
+    object, as the right hand operand if `reflected` """
+    if reflected:
+        def method(self, other):
+            return operation(other, self._resolve())
+    else:
+        def method(self, *args):
+            return operation(self._resolve(), *args)
+    return method
+
+
+class DeferredObject(object):
+    """ Placeholder for a console or environment object provided by a module
+    that has not been imported yet.
+
+    The module is imported the first time the placeholder is used, after which
+    the placeholder forwards everything to the real object.  Special methods
+    are looked up on the type rather than through `__getattr__`, so the
+    container, comparison, conversion and arithmetic ones are forwarded
+    explicitly.
+    """
+    __slots__ = ['_env', '_entry_name', '_key', '_kind']
+
+    def __init__(self, env, entry_name, key, kind):
+        self._env = env
+        self._entry_name = entry_name
+        self._key = key
+        self._kind = kind
+
+    def _resolve(self):
+        env = self._env
+        env.load_deferred_module(self._entry_name)
+        if self._kind == 'env_objects':
+            value = getattr(env, self._key, None)
+        else:
+            value = env.get_console_object(self._key)
+        if value is None or isinstance(value, DeferredObject):
+            raise AttributeError('%s did not provide %s' %
+                                 (self._entry_name, self._key))
+        return value
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __dir__(self):
+        return dir(self._resolve())
+
+    def __repr__(self):
+        try:
+            return repr(self._resolve())
+        except AttributeError:
+            return '<DeferredObject %s from %s>' % (self._key,
+                                                    self._entry_name)
+
+    __str__ = _forward(str)
+    __unicode__ = _forward(unicode)
+    __nonzero__ = _forward(bool)
+    __hash__ = _forward(hash)
+    __int__ = _forward(int)
+    __long__ = _forward(long)
+    __float__ = _forward(float)
+    __index__ = _forward(operator.index)
+    __hex__ = _forward(hex)
+    __oct__ = _forward(oct)
+
+    __len__ = _forward(len)
+    __iter__ = _forward(iter)
+    __contains__ = _forward(operator.contains)
+    __getitem__ = _forward(operator.getitem)
+    __setitem__ = _forward(operator.setitem)
+    __delitem__ = _forward(operator.delitem)
+
+    __eq__ = _forward(operator.eq)
+    __ne__ = _forward(operator.ne)
+    __lt__ = _forward(operator.lt)
+    __le__ = _forward(operator.le)
+    __gt__ = _forward(operator.gt)
+    __ge__ = _forward(operator.ge)
+
+    __neg__ = _forward(operator.neg)
+    __pos__ = _forward(operator.pos)
+    __abs__ = _forward(abs)
+    __invert__ = _forward(operator.invert)
+    __add__ = _forward(operator.add)
+    __radd__ = _forward(operator.add, True)
+    __sub__ = _forward(operator.sub)
+    __rsub__ = _forward(operator.sub, True)
+    __mul__ = _forward(operator.mul)
+    __rmul__ = _forward(operator.mul, True)
+    __div__ = _forward(operator.div)
+    __rdiv__ = _forward(operator.div, True)
+    __truediv__ = _forward(operator.truediv)
+    __rtruediv__ = _forward(operator.truediv, True)
+    __floordiv__ = _forward(operator.floordiv)
+    __rfloordiv__ = _forward(operator.floordiv, True)
+    __mod__ = _forward(operator.mod)
+    __rmod__ = _forward(operator.mod, True)
+    __pow__ = _forward(pow)
+    __rpow__ = _forward(pow, True)
+    __and__ = _forward(operator.and_)
+    __rand__ = _forward(operator.and_, True)
+    __or__ = _forward(operator.or_)
+    __ror__ = _forward(operator.or_, True)
+    __xor__ = _forward(operator.xor)
+    __rxor__ = _forward(operator.xor, True)
+    __lshift__ = _forward(operator.lshift)
+    __rlshift__ = _forward(operator.lshift, True)
+    __rshift__ = _forward(operator.rshift)
+    __rrshift__ = _forward(operator.rshift, True)
+
+
+class DeferredCommand(object):
+    """ Stand-in command provider for a module that has not been imported yet.
+
+    Running a command imports the module and hands the command over to the
+    provider that module registered.
+    """
+
+    def __init__(self, env, entry_name):
+        self.env = env
+        self.entry_name = entry_name
+
+    def match(self, cmd):
+        return False
+
+    def run(self, cmd, *args, **kwargs):
+        self.env.load_deferred_module(self.entry_name)
+        command = self.env.find_command(cmd)
+        if command is None or isinstance(command, DeferredCommand):
+            print("Could not find implementation for %s" % str(cmd))
+        else:
+            return command.run(cmd, *args, **kwargs)
+
+
 class Environment(Component, ComponentManager):
     """The environment loads plugins """
 
     commands = ExtensionPoint(IShellCommandProvider)
     console_objects = ExtensionPoint(IShellConsoleObjectProvider)
     env_objects = ExtensionPoint(IEnvObjectProvider)
+    config_listeners = ExtensionPoint(IConfigurationChangeListener)
+
+    watch_config = BoolOption('dustbowl', 'watch_config', False,
+        """Reload the configuration in the background when its files change.
+        """)
+
+    watch_config_interval = IntOption('dustbowl', 'watch_config_interval', 2,
+        """Number of seconds between checks for configuration changes.""")
 
     def __init__(self, config=None, entry_point=None, plugins=None,
-                logger=None, locals=None):
+                logger=None, locals=None, plugin_cache=None,
+                rescan_plugins=False, profiler=None):
         """Initialize the Dustbowl environment.
 
         @param config: the absolute path to a configuration file.
@@ -69,37 +325,176 @@ class Environment(Component, ComponentManager):
                         plugins loaded from the specified path should be
                         auto-enabled.
         @param logger: a Python logger instance.
+        @param plugin_cache: path of the file in which discovered plugin entry
+                             points are cached between runs.  No cache is used
+                             if not specified.
+        @param rescan_plugins: ignore the plugin cache and scan for plugins.
+        @param profiler: a `StartupProfiler` recording the time spent in each
+                         phase of the initialization.
 
         ``sys.path`` will be automatically added to the list of plugin
         directories.  All entries of ``sys.path`` will not be auto-enabled.
         """
         ComponentManager.__init__(self)
 
-
-        self.setup_config(config)
+        self.profiler = profiler or NullProfiler()
+        # Serializes the activation of components and the loading of deferred
+        # modules, which may be triggered from background jobs
+        self._lock = threading.RLock()
+        # Number of commands that could not be found or raised an error,
+        # which are otherwise only reported to the user
+        self.failed_commands = 0
+        # Called with the command and the coroutine returned by a command,
+        # when the console runs an event loop
+        self.schedule_coroutine = None
+
+        with self.profiler.phase('Parse configuration'):
+            self.setup_config(config)
         self.setup_log(logger)
 
         # Load plugins
         self.plugin_data = dict()
+        self.plugin_cache = plugin_cache
+        self._matcher = None
         if not plugins:
             plugins = list()
-        self.load_modules(plugins, entry_point=entry_point)
+        self.load_modules(plugins, entry_point=entry_point,
+                          rescan=rescan_plugins)
+
+        # Build the command index now so that conflicting command names are
+        # reported at startup
+        self._command_index = None
+        # Conflicts already logged, as the index is rebuilt whenever
+        # components are added or enabled
+        self._reported_conflicts = set()
+        with self.profiler.phase('Build command index'):
+            self._build_command_index()
 
         if locals:
             self.parent_locals = locals
 
+        self._injected = set()
+        with self.profiler.phase('Inject console and env objects'):
+            self.inject_objects()
+
+        # Register placeholders for the objects of deferred modules
+        for entry_name, data in self.plugin_data.iteritems():
+            deferred = data.get('deferred')
+            if not deferred:
+                continue
+            for key in deferred['console_objects']:
+                self.add_console_object(key,
+                        DeferredObject(self, entry_name, key,
+                                       'console_objects'), entry_name)
+            for key in deferred['env_objects']:
+                self.add_env_object(key,
+                        DeferredObject(self, entry_name, key, 'env_objects'),
+                        entry_name)
+            continue
+
+        self.config_watcher = None
+        if self.watch_config:
+            self.start_config_watcher()
+
+    def start_config_watcher(self, interval=None):
+        """ Reload the configuration from a background thread whenever it
+        changes, notifying the `IConfigurationChangeListener` components.
+        """
+        if self.config_watcher is None:
+            self.config_watcher = ConfigurationWatcher(self.config,
+                    self.notify_config_changed,
+                    interval or self.watch_config_interval or 2, log=self.log)
+        self.config_watcher.start()
+
+    def stop_config_watcher(self):
+        """ Stop watching the configuration for changes. """
+        if self.config_watcher is not None:
+            self.config_watcher.stop()
+
+    #noinspection PyBroadException
+    def notify_config_changed(self, changes):
+        """ Tell every `IConfigurationChangeListener` which options changed.
+
+        Listeners are called from the thread that reloaded the configuration.
+        """
+        self.log.info('Configuration reloaded: %d option(s) changed',
+                      len(changes))
+        for listener in self.config_listeners:
+            try:
+                listener.config_changed(changes)
+            except:
+                self.log.error('Error in %s while handling configuration '
+                               'changes', listener.__class__.__name__,
+                               exc_info=True)
+            continue
+
+    def inject_objects(self):
+        """ Add the objects of every console and environment object provider
+        that has not provided its objects yet.
+        """
         for provider in self.console_objects:
+            if (IShellConsoleObjectProvider, provider.__class__) in \
+               self._injected:
+                continue
+            self._injected.add((IShellConsoleObjectProvider,
+                                provider.__class__))
             for key, value in provider.get_console_objects():
                 self.add_console_object(key, value, provider.__class__.__name__)
                 continue
             continue
 
         for provider in self.env_objects:
+            if (IEnvObjectProvider, provider.__class__) in self._injected:
+                continue
+            self._injected.add((IEnvObjectProvider, provider.__class__))
             for key, value in provider.get_env_objects():
                 self.add_env_object(key, value, provider.__class__.__name__)
                 continue
             continue
 
+    def load_deferred_module(self, entry_name):
+        """ Import a module whose loading was deferred and add the objects it
+        provides.
+
+        Does nothing if the module is not deferred or was already imported.
+        """
+        with self._lock:
+            data = self.plugin_data.get(entry_name)
+            if not data or not data.get('deferred'):
+                return
+            deferred = data['deferred']
+            data['deferred'] = None
+            self.log.debug('Loading deferred module %s', entry_name)
+
+            for key in deferred['console_objects']:
+                self._remove_deferred_console_object(key)
+            for key in deferred['env_objects']:
+                if isinstance(self.__dict__.get(key), DeferredObject):
+                    delattr(self, key)
+
+            self._load_module(data)
+            # Components of the module registered before it was loaded, if
+            # it was imported meanwhile, may have been found disabled
+            module = data['entry'].module_name
+            for cls in self.enabled.keys():
+                if cls.__module__ == module or \
+                   cls.__module__.startswith(module + '.'):
+                    del self.enabled[cls]
+            # Drop the deferred commands from the command index
+            self._generation += 1
+            self.inject_objects()
+
+    def __getitem__(self, cls):
+        """Activate the component, recording the time its initializer takes
+        while the environment is being profiled.
+        """
+        with self._lock:
+            if cls in self.components or \
+               isinstance(self.profiler, NullProfiler):
+                return ComponentManager.__getitem__(self, cls)
+            with self.profiler.phase(cls.__module__ + '.' + cls.__name__,
+                                     'component'):
+                return ComponentManager.__getitem__(self, cls)
 
     def component_activated(self, component):
         """Initialize additional member variables for components.
@@ -123,15 +518,28 @@ class Environment(Component, ComponentManager):
         else:
             component_name = cls.lower()
 
-        for key, value in self.plugin_data.iteritems():
-            if component_name == key or component_name.startswith(key + '.'):
-                value['activated'] = True
-                return value['loaded']
-        return False
+        value = self.get_enablement_matcher().find_plugin(component_name)
+        if value is None:
+            return False
+        value['activated'] = True
+        return value['loaded']
+
+    def get_enablement_matcher(self):
+        """Return the `EnablementMatcher` for the current plugins and config.
+
+        The matcher is rebuilt when the configuration, or a file it inherits
+        from, changes or when the set of known plugins changes.
+        """
+        matcher = self._matcher
+        if matcher is None or \
+           matcher.generation != self.config._chain_token():
+            matcher = EnablementMatcher(self.plugin_data, self.config)
+            self._matcher = matcher
+        return matcher
 
     def setup_config(self, configpath):
         """Load the configuration file."""
-        self.config = Configuration(configpath)
+        self.config = Configuration(configpath, snapshot=True)
 
     def setup_log(self, logger):
         """Initialize the logging sub-system."""
@@ -143,29 +551,121 @@ class Environment(Component, ComponentManager):
     def is_enabled(self, module_name):
         """ Return whether a module is enabled in the config.
         """
-        for key, value in self.config.options('components'):
-            k = key.lower()
-            mod = module_name.lower()
-            if mod == k or k.endswith('*') and mod.startswith(k[:-1]):
-                return self.config.getbool('components', key)
-        return False
+        return self.get_enablement_matcher().is_module_enabled(module_name)
 
-    def load_modules(self, plugins=None, entry_point='dustbowl.modules'):
-        """ Load plugins """
-        def _log_error(item, e):
-            ue = format_exception(e)
-            if isinstance(e, DistributionNotFound):
-                self.log.debug('Skipping "%s": ("%s" not found)', item, ue)
-            elif isinstance(e, VersionConflict):
-                self.log.error('Skipping "%s": (version conflict "%s")',
-                              item, ue)
-            elif isinstance(e, UnknownExtra):
-                self.log.error('Skipping "%s": (unknown extra "%s")', item, ue)
-            elif isinstance(e, ImportError):
-                self.log.error('Skipping "%s": (can\'t import "%s")', item, ue)
-            else:
-                self.log.error('Skipping "%s": (error "%s")', item, ue)
+    def load_modules(self, plugins=None, entry_point='dustbowl.modules',
+                     rescan=False):
+        """ Load plugins
 
+        The discovered entry points are read from the plugin cache when none
+        of the searched paths have changed since it was written, unless
+        `rescan` is True.
+        """
+        plugins = plugins or []
+        entries = None
+        errors = {}
+        if self.plugin_cache and not rescan:
+            with self.profiler.phase('Read plugin cache'):
+                entries = self._read_plugin_cache(plugins, entry_point)
+        if entries is None:
+            with self.profiler.phase('Scan for plugins'):
+                entries, errors = self._scan_entry_points(plugins,
+                                                          entry_point)
+            # Only clean scans are cached so that errors keep being reported
+            if self.plugin_cache and not errors:
+                self._write_plugin_cache(plugins, entry_point, entries)
+
+        for entry, auto_enable in entries:
+            entry_data = {
+                'entry' : entry,
+                'loaded' : False,
+                'activated' : False,
+                'auto_enable' : auto_enable,
+                'deferred' : None,
+            }
+            self.plugin_data.setdefault(entry.name, entry_data)
+
+        # The set of plugins changed, so the enablement decisions must be
+        # recomputed
+        self._matcher = None
+
+        for entry_name, data in self.plugin_data.iteritems():
+            if data['auto_enable'] or self.is_enabled(entry_name):
+                # A module imported already, for instance by a plugin using
+                # its interfaces, has nothing left to defer
+                if data['entry'].module_name not in sys.modules:
+                    data['deferred'] = self._get_deferred(data['entry'])
+                if data['deferred']:
+                    self.log.debug('Deferring %s from %s', data['entry'].name,
+                                   data['entry'].dist)
+                else:
+                    self._load_module(data)
+            continue
+
+
+        for dist, e in errors.iteritems():
+            self._log_error(dist, e)
+
+    def _log_error(self, item, e):
+        """ Log an error raised while looking for or loading a module """
+        ue = format_exception(e)
+        if isinstance(e, DistributionNotFound):
+            self.log.debug('Skipping "%s": ("%s" not found)', item, ue)
+        elif isinstance(e, VersionConflict):
+            self.log.error('Skipping "%s": (version conflict "%s")',
+                          item, ue)
+        elif isinstance(e, UnknownExtra):
+            self.log.error('Skipping "%s": (unknown extra "%s")', item, ue)
+        elif isinstance(e, ImportError):
+            self.log.error('Skipping "%s": (can\'t import "%s")', item, ue)
+        else:
+            self.log.error('Skipping "%s": (error "%s")', item, ue)
+
+    def _load_module(self, data):
+        """ Import the module of the given plugin data entry """
+        try:
+            self.log.debug('Loading %s from %s', data['entry'].name,
+                          data['entry'].dist)
+            with self.profiler.phase(data['entry'].name, 'import'):
+                # We need to make sure the distribution is on the path
+                # before we can load it.
+                data['entry'].dist.activate()
+                data['entry'].load(require=True)
+            data['loaded'] = True
+        except (ImportError, DistributionNotFound, VersionConflict,
+                UnknownExtra), e:
+            # Print the last traceback to the debug buffer
+            self._log_error(data['entry'], e)
+
+    def _get_deferred(self, entry):
+        """ Return what the module of `entry` declares to provide.
+
+        Modules declare the commands, console objects and environment objects
+        they provide in the ``dustbowl.commands``, ``dustbowl.console_objects``
+        and ``dustbowl.env_objects`` entry point groups of their distribution,
+        naming themselves as the target.  Returns a dictionary of lists keyed
+        by ``commands``, ``console_objects`` and ``env_objects``, or ``None``
+        if the module declares nothing and must be imported right away.
+        """
+        if entry.dist is None:
+            return None
+        deferred = {}
+        declared = False
+        for kind, group in DEFERRED_GROUPS.iteritems():
+            names = [ep.name for ep in entry.dist.get_entry_map(group).values()
+                     if ep.module_name == entry.module_name]
+            deferred[kind] = sorted(names)
+            declared |= bool(names)
+        return declared and deferred or None
+
+    def _scan_entry_points(self, plugins, entry_point):
+        """ Search the core modules, ``sys.path`` and the plugin directories
+        for entry points.
+
+        Returns a list of `(entry, auto_enable)` tuples in discovery order and
+        the dictionary of errors reported while looking for plugins.
+        """
+        entries = []
         ws = pkg_resources.WorkingSet(sys.path)
 
         # Look for core modules
@@ -173,25 +673,13 @@ class Environment(Component, ComponentManager):
                         pkg_resources.resource_filename(__name__, '')))
         for entry in ws.iter_entry_points(entry_point):
             if entry.name.startswith('dustbowl.plugins'):
-                entry_data = {
-                    'entry' : entry,
-                    'loaded' : False,
-                    'activated' : False,
-                    'auto_enable' : True,
-                }
-                self.plugin_data.setdefault(entry.name, entry_data)
+                entries.append((entry, True))
 
         # Look for modules in sys.path
         for p in sys.path:
             ws.add_entry(p)
         for entry in ws.iter_entry_points(entry_point):
-            entry_data = {
-                'entry' : entry,
-                'loaded' : False,
-                'activated' : False,
-                'auto_enable' : False,
-            }
-            self.plugin_data.setdefault(entry.name, entry_data)
+            entries.append((entry, False))
 
         # Look for modules from plugin dir specified in the config or on the
         # command line
@@ -202,49 +690,207 @@ class Environment(Component, ComponentManager):
             ws.add(dist)
 
         for entry in ws.iter_entry_points(entry_point):
-            entry_data = {
-                'entry' : entry,
-                'loaded' : False,
-                'activated' : False,
-                'auto_enable' : False,
-                }
-            self.plugin_data.setdefault(entry.name, entry_data)
-
-        for entry_name, data in self.plugin_data.iteritems():
-            if data['auto_enable'] or self.is_enabled(entry_name):
-                try:
-                    self.log.debug('Loading %s from %s', data['entry'].name,
-                                  data['entry'].dist)
-                    # We need to make sure the distribution is on the path
-                    # before we can load it.
-                    data['entry'].dist.activate()
-                    data['entry'].load(require=True)
-                    data['loaded'] = True
-                except (ImportError, DistributionNotFound, VersionConflict,
-                        UnknownExtra), e:
-                    # Print the last traceback to the debug buffer
-                    _log_error(data['entry'], e)
+            entries.append((entry, False))
+
+        # Later duplicates are ignored when building ``plugin_data``, so they
+        # are dropped here to keep the cache small
+        seen = set()
+        unique = []
+        for entry, auto_enable in entries:
+            if entry.name not in seen:
+                seen.add(entry.name)
+                unique.append((entry, auto_enable))
+        return unique, errors
+
+    def _plugin_cache_key(self, plugins, entry_point):
+        """ Return the paths searched for plugins along with their mtimes """
+        paths = [os.path.dirname(pkg_resources.resource_filename(__name__, ''))]
+        paths.extend(sys.path)
+        paths.extend(plugins)
+        return (entry_point,
+                [(os.path.abspath(p), _get_mtime(p)) for p in paths])
+
+    def _read_plugin_cache(self, plugins, entry_point):
+        """ Return the cached `(entry, auto_enable)` tuples, or ``None`` if
+        the cache is missing or out of date.
+        """
+        try:
+            fileobj = open(self.plugin_cache, 'rb')
+            try:
+                cache = pickle.load(fileobj)
+            finally:
+                fileobj.close()
+        except IOError, e:
+            self.log.debug('Not using plugin cache %s: %s', self.plugin_cache,
+                           format_exception(e))
+            return None
+        #noinspection PyBroadException
+        except Exception, e:
+            # A truncated or otherwise corrupt cache is simply rebuilt
+            self.log.debug('Ignoring corrupt plugin cache %s: %s',
+                           self.plugin_cache, format_exception(e))
+            return None
+
+        if cache.get('key') != self._plugin_cache_key(plugins, entry_point):
+            self.log.debug('Plugin cache %s is out of date', self.plugin_cache)
+            return None
+
+        dists = []
+        for location, egg_info, mtime in cache['dists']:
+            if _get_mtime(egg_info) != mtime:
+                self.log.debug('Plugin cache %s is out of date',
+                               self.plugin_cache)
+                return None
+            basename = os.path.basename(egg_info)
+            if basename == 'EGG-INFO':
+                basename = os.path.basename(location)
+            metadata = pkg_resources.PathMetadata(location, egg_info)
+            dists.append(pkg_resources.Distribution.from_location(
+                                            location, basename, metadata))
+
+        entries = []
+        for src, dist_idx, auto_enable in cache['entries']:
+            entry = pkg_resources.EntryPoint.parse(src, dists[dist_idx])
+            entries.append((entry, auto_enable))
+        self.log.debug('Read %d entry points from plugin cache %s',
+                       len(entries), self.plugin_cache)
+        return entries
+
+    def _write_plugin_cache(self, plugins, entry_point, entries):
+        """ Save the discovered entry points to the plugin cache """
+        dists = []
+        dist_index = {}
+        cached_entries = []
+        for entry, auto_enable in entries:
+            dist = entry.dist
+            if dist not in dist_index:
+                egg_info = getattr(dist._provider, 'egg_info', None)
+                if not egg_info or not os.path.isdir(egg_info):
+                    # Zipped eggs and the like can not be rebuilt from a path
+                    self.log.debug('Not caching plugins: %s can not be '
+                                   'cached', dist)
+                    return
+                dist_index[dist] = len(dists)
+                dists.append((dist.location, egg_info, _get_mtime(egg_info)))
+            cached_entries.append((str(entry), dist_index[dist], auto_enable))
+
+        cache = {
+            'key' : self._plugin_cache_key(plugins, entry_point),
+            'dists' : dists,
+            'entries' : cached_entries,
+        }
+        tmpname = '%s.%d.tmp' % (self.plugin_cache, os.getpid())
+        try:
+            fileobj = open(tmpname, 'wb')
+            try:
+                pickle.dump(cache, fileobj, pickle.HIGHEST_PROTOCOL)
+            finally:
+                fileobj.close()
+            os.rename(tmpname, self.plugin_cache)
+        except (IOError, OSError), e:
+            self.log.debug('Unable to write plugin cache %s: %s',
+                           self.plugin_cache, format_exception(e))
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+
+    def _build_command_index(self):
+        """ Build the prefix trie used to route commands to their providers.
+
+        Each node of the trie is a dictionary keyed by a command name part.
+        The provider owning a node is stored under the ``None`` key.
+        Providers that do not declare their command names are kept aside and
+        consulted via `match()` when the trie can not route a command.
+        """
+        index = {}
+        dynamic = []
+        generation = (ComponentMeta._generation, self._generation)
+        for provider in self.commands:
+            get_prefixes = getattr(provider, 'get_command_prefixes', None)
+            if get_prefixes is None:
+                dynamic.append(provider)
+                continue
+            for prefix in get_prefixes():
+                node = index
+                for part in prefix.lower().split('.'):
+                    node = node.setdefault(part, {})
+                owner = node.setdefault(None, provider)
+                if owner is not provider:
+                    self._report_conflict(prefix, owner.__class__.__name__,
+                                          provider.__class__.__name__)
+                continue
             continue
 
+        # Commands of deferred modules are routed to a stand-in that imports
+        # the module on first use
+        for entry_name, data in sorted(self.plugin_data.iteritems()):
+            if not data.get('deferred'):
+                continue
+            provider = DeferredCommand(self, entry_name)
+            for prefix in data['deferred']['commands']:
+                node = index
+                for part in prefix.lower().split('.'):
+                    node = node.setdefault(part, {})
+                owner = node.setdefault(None, provider)
+                if owner is not provider:
+                    self._report_conflict(prefix, owner.__class__.__name__,
+                                          entry_name)
+                continue
+            continue
+        self._command_index = (generation, index, dynamic)
 
-        for dist, e in errors.iteritems():
-            _log_error(dist, e)
-
+    def _report_conflict(self, prefix, owner, other):
+        """ Log that a command is provided twice, unless already logged """
+        key = (prefix.lower(), owner, other)
+        if key in self._reported_conflicts:
+            return
+        self._reported_conflicts.add(key)
+        self.log.error('The command "%s" is provided by both %s and %s.  '
+                       'Using %s', prefix, owner, other, owner)
+
+    def find_command(self, cmd):
+        """ Return the provider that handles the given command, or ``None`` """
+        generation = (ComponentMeta._generation, self._generation)
+        if self._command_index[0] != generation:
+            self._build_command_index()
+        generation, node, dynamic = self._command_index
+        provider = None
+        for part in cmd.lower().split('.'):
+            node = node.get(part)
+            if node is None:
+                break
+            provider = node.get(None, provider)
+        if provider is not None:
+            return provider
+        for command in dynamic:
+            if command.match(cmd):
+                return command
+        return None
 
     #noinspection PyBroadException
     def __call__(self, cmd, *args, **kwargs):
-        """ Invoke a command """
+        """ Invoke a command
+
+        A command may return a coroutine, made with the
+        `dustbowl.loop.coroutine` decorator, which is handed to
+        `schedule_coroutine` and the task running it returned.
+        """
         try:
-            for command in self.commands:
-                if command.match(cmd):
-                    command.run(cmd, *args, **kwargs)
-                    break
-                continue
+            command = self.find_command(cmd)
+            if command is not None:
+                result = command.run(cmd, *args, **kwargs)
+                if isinstance(result, Coroutine):
+                    if self.schedule_coroutine is not None:
+                        return self.schedule_coroutine(cmd, result)
+                    self.failed_commands += 1
+                    print("%s needs the event loop of the console, see "
+                          "--async" % str(cmd))
             else:
+                self.failed_commands += 1
                 print("Could not find implementation for %s" % str(cmd))
         except:
+            self.failed_commands += 1
             print("Error when calling %s.  See the log for details" % str(cmd))
-            self.log.error("Error calling %s" % str(cmd), exc_info=True)
+            self.log.error("Error calling %s", cmd, exc_info=True)
 
     def _add_namespace_console_object(self, parts, value):
         """ Return the namesapce object with the value attached.
@@ -271,6 +917,25 @@ class Environment(Component, ComponentManager):
         self.parent_locals[namespaces[0]] = global_ns
 
 
+    def get_console_object(self, key):
+        """ Return the console object with the given key, or ``None`` """
+        parts = key.split('.')
+        value = self.parent_locals.get(parts[0])
+        for part in parts[1:]:
+            value = getattr(value, part, None)
+        return value
+
+    def _remove_deferred_console_object(self, key):
+        """ Remove the placeholder for a deferred console object """
+        parts = key.split('.')
+        if len(parts) == 1:
+            if isinstance(self.parent_locals.get(key), DeferredObject):
+                del self.parent_locals[key]
+            return
+        ns_obj = self.get_console_object('.'.join(parts[:-1]))
+        if isinstance(getattr(ns_obj, parts[-1], None), DeferredObject):
+            delattr(ns_obj, parts[-1])
+
     def _add_global_console_object(self, key, value):
         """ Adds a console object without considering namespaces """
         if key in self.parent_locals:
@@ -280,13 +945,9 @@ class Environment(Component, ComponentManager):
 
     def add_console_object(self, key, value, provider=None):
         """ Add the value to the console context with the given key """
-        if provider is None:
-            caller_frame = inspect.stack()[1][0]
-            caller_class = ''
-            if 'self' in caller_frame.f_locals:
-                caller_class = caller_frame.f_locals['self'].__class__.__name__
-            provider = "%s%s" % (caller_class and (caller_class + '.') or '',
-                                 caller_frame.f_code.co_name)
+        # The provider is only named in log messages, so the caller is only
+        # looked up when one is logged
+        caller_frame = provider is None and sys._getframe(1) or None
 
         parts = key.split('.')
         is_ns = len(parts) > 1
@@ -295,32 +956,28 @@ class Environment(Component, ComponentManager):
                 self._add_global_console_object(key, value)
             else:
                 self._add_namespace_console_object(parts, value)
-            self.log.debug("%s added '%s' to the console" %
-                           (provider, '.'.join(parts) +
-                           (callable(value) and '()' or '')))
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug("%s added '%s%s' to the console",
+                               provider or _get_caller_name(caller_frame),
+                               key, callable(value) and '()' or '')
         except ConsoleObjectError, e:
-            self.log.error("%s  %s must provide a different key"
-                           % (e.msg, provider))
+            self.log.error("%s  %s must provide a different key", e.msg,
+                           provider or _get_caller_name(caller_frame))
             return
 
 
     def add_env_object(self, key, value, provider=None):
         """ Add the value to the environment as the given attribute """
-        if provider is None:
-            caller_frame = inspect.stack()[1][0]
-            caller_class = ''
-            if 'self' in caller_frame.f_locals:
-                caller_class = caller_frame.f_locals['self'].__class__.__name__ 
-            provider = "%s%s" % (caller_class and (caller_class + '.') or '',
-                                 caller_frame.f_code.co_name)
+        caller_frame = provider is None and sys._getframe(1) or None
 
         attr = getattr(self, key, None)
         if attr:
             self.log.error("The attribute/method >>%s<< already exists in the "
-                           "environment.  %s must provide a different "
-                           "key" % (str(key), provider))
+                           "environment.  %s must provide a different key",
+                           key, provider or _get_caller_name(caller_frame))
         else:
             setattr(self, key, value)
-            self.log.debug("%s added '%s' to the environemnt" %
-                           (provider,
-                            str(key) + (callable(value) and '()' or '')))
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug("%s added '%s%s' to the environemnt",
+                               provider or _get_caller_name(caller_frame),
+                               key, callable(value) and '()' or '')
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2009 John Hampton <pacopablo@pacopablo.com>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# Author: John Hampton <pacopablo@pacopablo.com>
+
+# Standard Library Imports
+import sys
+import thread
+import threading
+import time
+import traceback
+import Queue
+
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
+
+# Third Party Imports
+
+# Local Imports
+
+
+__all__ = [
+    'Job',
+    'JobManager',
+    'JobCancelled',
+]
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class JobCancelled(BaseException):
+    """ Raised in the thread of a running job when it is cancelled """
+
+
+def _set_async_exc(thread_id, exc_type):
+    """ Raise `exc_type` in the given thread, or clear the exception pending
+    there if ``None``.  Returns False if that is not possible. """
+    if ctypes is None:
+        return False
+    exc = exc_type and ctypes.py_object(exc_type) or None
+    return ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                                    ctypes.c_long(thread_id), exc) == 1
+
+
+class Job(object):
+    """ A piece of console input run by a `JobManager` worker thread.
+
+    `status` is one of ``pending``, ``running``, ``done``, ``failed`` and
+    ``cancelled``.  Once done, `result` holds the value of the input if it
+    was an expression.  If it failed, `exception` holds the exception raised
+    and `error` its formatted traceback.
+    """
+
+    def __init__(self, id, source, func):
+        self.id = id
+        self.source = source
+        self.func = func
+        self.status = PENDING
+        self.result = None
+        self.exception = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self._thread_id = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def __repr__(self):
+        return '<Job %d %s: %s>' % (self.id, self.describe(), self.source)
+
+    @property
+    def elapsed(self):
+        """ Seconds the job has been running, or ran for """
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def describe(self):
+        """ Return the status along with the time the job ran for """
+        if self.status == PENDING:
+            return self.status
+        return '%s %.1fs' % (self.status, self.elapsed)
+
+    def done(self):
+        """ Return whether the job has finished, one way or another """
+        return self._done.isSet()
+
+    def wait(self, timeout=None):
+        """ Wait for the job to finish.  Returns whether it has. """
+        self._done.wait(timeout)
+        return self._done.isSet()
+
+    def add_done_callback(self, func):
+        """ Call `func` with the job once it has finished, right away if it
+        already has.  It is called from the thread that finished the job. """
+        with self._lock:
+            if not self._done.isSet():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def cancel(self):
+        """ Cancel the job.
+
+        A pending job is simply not run.  A running job has `JobCancelled`
+        raised in its thread, which only interrupts Python code; a job
+        blocked in a call to a C extension is cancelled once that returns.
+        Returns False if the job could not be cancelled.
+        """
+        with self._lock:
+            if self.status == RUNNING:
+                return _set_async_exc(self._thread_id, JobCancelled)
+            if self.status != PENDING:
+                return False
+            self._finish(CANCELLED)
+        self._run_callbacks()
+        return True
+
+    #noinspection PyBroadException
+    def run(self):
+        """ Run the job in the calling thread """
+        with self._lock:
+            if self.status != PENDING:
+                return
+            self.status = RUNNING
+            self.started = time.time()
+            self._thread_id = thread.get_ident()
+        status = DONE
+        try:
+            try:
+                self.result = self.func()
+            except JobCancelled:
+                status = CANCELLED
+            except:
+                status = FAILED
+                exc_type, self.exception, tb = sys.exc_info()
+                # Leave this frame out of the traceback
+                self.error = ''.join(traceback.format_exception(
+                                        exc_type, self.exception, tb.tb_next))
+                del tb
+        except JobCancelled:
+            # Cancelled just as the job finished
+            status = CANCELLED
+        while True:
+            try:
+                with self._lock:
+                    # No cancellation may be raised once the lock is held,
+                    # except one that was already pending
+                    _set_async_exc(self._thread_id, None)
+                    self._finish(status)
+                break
+            except JobCancelled:
+                status = CANCELLED
+        self._run_callbacks()
+
+    def _finish(self, status):
+        self.status = status
+        self.finished = time.time()
+        self._thread_id = None
+        self.func = None
+        self._done.set()
+
+    #noinspection PyBroadException
+    def _run_callbacks(self):
+        with self._lock:
+            callbacks = self._callbacks
+            self._callbacks = []
+        for func in callbacks:
+            try:
+                func(self)
+            except:
+                traceback.print_exc()
+
+
+class JobManager(object):
+    """ Runs jobs on a pool of `workers` threads, started as needed.
+
+    Jobs are numbered from 1 and can be looked up by number.
+    """
+
+    def __init__(self, workers=4, log=None):
+        self.workers = max(workers, 1)
+        self.log = log
+        self.jobs = {}
+        self._next_id = 1
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._idle = 0
+        # Reentrant, as a job added once finished is reported right away
+        self._lock = threading.RLock()
+        self._finished = []
+
+    def __getitem__(self, id):
+        return self.jobs[id]
+
+    def __iter__(self):
+        return iter([self.jobs[id] for id in sorted(self.jobs)])
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __repr__(self):
+        return '\n'.join([repr(job) for job in self]) or '<No jobs>'
+
+    def submit(self, source, func):
+        """ Queue `func` to be run as a job described by `source` """
+        with self._lock:
+            job = self._add(Job(self._next_id, source, func))
+            if not self._idle and len(self._threads) < self.workers:
+                worker = threading.Thread(target=self._work,
+                            name='dustbowl-job-%d' % (len(self._threads) + 1))
+                worker.daemon = True
+                self._threads.append(worker)
+                worker.start()
+        self._queue.put(job)
+        return job
+
+    def add(self, job):
+        """ Number and keep track of a job run by other means, such as a
+        `dustbowl.loop.Task`. """
+        with self._lock:
+            job.id = self._next_id
+            return self._add(job)
+
+    def _add(self, job):
+        self.jobs[job.id] = job
+        self._next_id += 1
+        job.add_done_callback(self._job_finished)
+        return job
+
+    def cancel(self, id):
+        """ Cancel the job with the given number.  See `Job.cancel()`. """
+        return self.jobs[id].cancel()
+
+    def pop_finished(self):
+        """ Return the jobs that finished since the last call """
+        with self._lock:
+            finished = self._finished
+            self._finished = []
+        return finished
+
+    #noinspection PyBroadException
+    def _work(self):
+        while True:
+            with self._lock:
+                self._idle += 1
+            job = self._queue.get()
+            with self._lock:
+                self._idle -= 1
+            try:
+                job.run()
+            except JobCancelled:
+                # Raised between jobs, there is nothing left to cancel
+                pass
+
+    def _job_finished(self, job):
+        with self._lock:
+            self._finished.append(job)
+        if self.log:
+            self.log.info('Job %d %s: %s', job.id, job.describe(), job.source)
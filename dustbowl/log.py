@@ -9,9 +9,16 @@
 # Author: John Hampton <pacopablo@pacopablo.com>
 
 # Standard Library Imports
+import gzip
 import logging
 import logging.handlers
+import re
 import sys
+import threading
+import Queue
+from array import array
+from bisect import bisect_left
+from heapq import merge
 
 # Third Party Imports
 
@@ -21,6 +28,8 @@ import sys
 __all__ = [
     'get_logger',
     'BufferHandler',
+    'BackgroundFileHandler',
+    'open_log_file',
     'NullLogger',
     'NullHandler',
 ]
@@ -37,38 +46,556 @@ def NullLogger():
     return logger
 
 
+# The attributes of a `LogRecord` that are the same for every message logged
+# from the same place, which are stored once in the table of sites
+_SITE_FIELDS = ('name', 'msg', 'levelname', 'levelno', 'pathname', 'filename',
+                'module', 'lineno', 'funcName', 'thread', 'threadName',
+                'processName', 'process')
+
+# The attributes every `LogRecord` has, or gets once formatted.  Any other
+# attribute, such as one given with ``extra``, is stored with the message.
+_RECORD_FIELDS = frozenset(logging.makeLogRecord({}).__dict__) | \
+                 frozenset(['message', 'asctime'])
+
+# Argument types that can not change between logging and formatting
+_IMMUTABLE_TYPES = (str, unicode, int, long, float, bool, type(None))
+
+# Message templates stop being shared between messages once there are this
+# many sites, in case the templates are themselves built dynamically
+_MAX_SITES = 4096
+
+# Rough size of the fields added to each message by a typical format
+_RECORD_OVERHEAD = 80
+
+# Number of messages formatted and written at a time when saving the log
+_SAVE_BATCH = 1000
+
+
+def open_log_file(filename, mode='wb', compress=None):
+    """ Open a file to save log messages to.
+
+    The file is compressed with gzip if `compress` is true, or if it is
+    ``None`` and `filename` ends with ``.gz``.
+    """
+    if compress is None:
+        compress = filename.endswith('.gz')
+    if compress:
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+
+#noinspection PyBroadException
+def _format(handler, record):
+    """ Format `record` with `handler`, reporting a failure with
+    `handleError()` and falling back on the bare message. """
+    try:
+        return logging.Handler.format(handler, record)
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except:
+        handler.handleError(record)
+    try:
+        return record.getMessage()
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except:
+        return repr(record.msg)
+
+
+def _encode(text):
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
+class _Chunk(object):
+    """ Columns holding a fixed number of buffered messages """
+    __slots__ = ('created', 'sites', 'args', 'exc_text', 'extra', 'levels',
+                 'min_created', 'max_created')
+    size = 1024
+
+    def __init__(self):
+        self.created = array('d')
+        self.sites = array('i')
+        # The arguments of the message, or the message itself if it has no
+        # arguments or has been formatted when logged
+        self.args = []
+        # The traceback and the additional attributes of the messages that
+        # have them, by position
+        self.exc_text = None
+        self.extra = None
+        # Positions of the messages of each level, and the time range of the
+        # messages, used to skip over messages when searching
+        self.levels = {}
+        self.min_created = None
+        self.max_created = None
+
+
 class BufferHandler(logging.Handler):
-    """ Simple Log handler that buffers messages into a list """
-    def __init__(self, level=logging.NOTSET):
+    """ Log handler that buffers messages until they are shown
+
+    Messages are stored in a compact raw form and are only formatted when
+    they are requested with `get_lines()`.  The attributes shared by the
+    messages logged from the same place are stored once, so that little more
+    than the time and the arguments is kept per message.  Messages whose
+    arguments are mutable objects are formatted right away, so that they show
+    the arguments as they were when logged.
+
+    By default every message is kept.  If `max_records` or `max_bytes` is
+    given, the buffer holds at most that many messages or (approximately)
+    bytes of formatted text, and the oldest messages are evicted to make
+    room for new ones.  Evicted messages are formatted and appended to the
+    file `spill`, if given, which is rotated once it reaches `spill_size`
+    bytes, keeping `spill_count` old files.
+
+    Messages are numbered from the start of the log, or from the last
+    `clear_log()`, and keep their number when older ones are evicted.
+    `get_length()` returns the number of the next message and `get_first()`
+    the number of the oldest message still buffered.
+
+    Messages may be logged and read from any thread; the buffer is only
+    changed and read while holding the lock of the handler.
+    """
+    def __init__(self, level=logging.NOTSET, max_records=0, max_bytes=0,
+                 spill='', spill_size=10 * 1024 * 1024, spill_count=5):
         logging.Handler.__init__(self, level)
-        self.buffer = []
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.spill = None
+        if spill:
+            self.spill = logging.handlers.RotatingFileHandler(spill,
+                                maxBytes=spill_size, backupCount=spill_count,
+                                encoding='utf-8', delay=True)
+        self.clear_log()
 
     def emit(self, record):
         """ Add the message to the buffer """
         try:
-            self.buffer.extend(self.format(record).split('\n'))
+            d = record.__dict__
+            args = record.args
+            if not args:
+                msg = None
+                args = record.getMessage()
+            elif not isinstance(args, tuple) or \
+                 [arg for arg in args if type(arg) not in _IMMUTABLE_TYPES]:
+                msg = None
+                args = record.getMessage()
+            else:
+                msg = record.msg
+            site = (d['name'], msg) + \
+                   tuple([d.get(field) for field in _SITE_FIELDS[2:]])
+            site_id = self.site_ids.get(site)
+            if site_id is None:
+                if msg is not None and len(self.sites) >= _MAX_SITES:
+                    site = (site[0], None) + site[2:]
+                    args = record.getMessage()
+                    site_id = self.site_ids.get(site)
+                if site_id is None:
+                    site_id = self.site_ids[site] = len(self.sites)
+                    self.sites.append(site)
+
+            chunk = self.chunks[-1]
+            if len(chunk.args) >= chunk.size:
+                chunk = _Chunk()
+                self.chunks.append(chunk)
+            if record.exc_info or record.exc_text:
+                if record.exc_info and not record.exc_text:
+                    # Tracebacks keep every frame alive, so format them now
+                    formatter = self.formatter or logging._defaultFormatter
+                    record.exc_text = formatter.formatException(
+                                                        record.exc_info)
+                if chunk.exc_text is None:
+                    chunk.exc_text = {}
+                chunk.exc_text[len(chunk.args)] = record.exc_text
+            if not _RECORD_FIELDS.issuperset(d):
+                if chunk.extra is None:
+                    chunk.extra = {}
+                chunk.extra[len(chunk.args)] = dict(
+                        [(key, value) for key, value in d.iteritems()
+                         if key not in _RECORD_FIELDS])
+            levelno = site[3]
+            positions = chunk.levels.get(levelno)
+            if positions is None:
+                positions = chunk.levels[levelno] = array('H')
+            positions.append(len(chunk.args))
+            created = record.created
+            if chunk.min_created is None or created < chunk.min_created:
+                chunk.min_created = created
+            if chunk.max_created is None or created > chunk.max_created:
+                chunk.max_created = created
+            chunk.created.append(created)
+            chunk.sites.append(site_id)
+            chunk.args.append(args)
+            self.count += 1
+            if self.max_bytes:
+                self.size += self._estimate_size(site, args)
+            self._evict()
         except (KeyboardInterrupt, SystemExit):
             raise
         except:
             self.handleError(record)
 
+    @staticmethod
+    def _estimate_size(site, args):
+        if site[1] is None:
+            return len(args) + _RECORD_OVERHEAD
+        size = len(site[1]) + _RECORD_OVERHEAD
+        for arg in args:
+            if isinstance(arg, basestring):
+                size += len(arg)
+            else:
+                size += 8
+        return size
+
+    def _get_record(self, index):
+        """ Return the `LogRecord` of the message with the given position in
+        the buffer, counting from the oldest message still buffered. """
+        index += self.offset
+        chunk = self.chunks[index // _Chunk.size]
+        index %= _Chunk.size
+        d = dict(zip(_SITE_FIELDS, self.sites[chunk.sites[index]]))
+        args = chunk.args[index]
+        if d['msg'] is None:
+            d['msg'] = args
+            args = ()
+        created = chunk.created[index]
+        d['args'] = args
+        d['created'] = created
+        d['msecs'] = (created - long(created)) * 1000
+        d['relativeCreated'] = (created - logging._startTime) * 1000
+        if chunk.exc_text:
+            d['exc_text'] = chunk.exc_text.get(index)
+        if chunk.extra and index in chunk.extra:
+            d.update(chunk.extra[index])
+        return logging.makeLogRecord(d)
+
+    def _evict(self):
+        """ Drop the oldest messages until the buffer is within its bounds """
+        evicted = []
+        while self.count and \
+              (self.max_records and self.count > self.max_records or
+               self.max_bytes and self.size > self.max_bytes):
+            chunk = self.chunks[0]
+            index = self.offset
+            if self.spill:
+                evicted.append(self._get_record(0))
+            if self.max_bytes:
+                self.size -= self._estimate_size(
+                                self.sites[chunk.sites[index]],
+                                chunk.args[index])
+            # Release the arguments now rather than with the whole chunk
+            chunk.args[index] = None
+            if chunk.extra:
+                chunk.extra.pop(index, None)
+            self.offset += 1
+            self.count -= 1
+            self.first += 1
+            if self.offset == chunk.size:
+                del self.chunks[0]
+                self.offset = 0
+        if not self.chunks:
+            self.chunks.append(_Chunk())
+        if evicted:
+            self.spill.handle(logging.makeLogRecord({
+                'msg' : '\n'.join([self.format(record)
+                                   for record in evicted]),
+                'levelno' : logging.NOTSET,
+            }))
+
     def get_length(self):
-        return len(self.buffer)
+        self.acquire()
+        try:
+            return self.first + self.count
+        finally:
+            self.release()
 
-    def get_lines(self, start=0, end=-1):
+    def get_first(self):
+        return self.first
+
+    def get_records(self, start=0, end=-1):
+        """ Return the `LogRecord` of each of the given messages """
+        self.acquire()
+        try:
+            length = self.get_length()
+            if end < 0 or end > length:
+                end = length
+            start = max(start, self.first)
+            return [self._get_record(index - self.first)
+                    for index in xrange(start, end)]
+        finally:
+            self.release()
+
+    def iter_records(self, start=0, end=-1, batch=_SAVE_BATCH):
+        """ Iterate over the `LogRecord` of the given messages.
+
+        The records are fetched `batch` at a time, so that messages can be
+        logged from other threads while iterating.
+        """
         if end < 0:
-            return self.buffer[start:]
-        else:
-            return self.buffer[start:end]
+            end = self.get_length()
+        while start < end:
+            records = self.get_records(start, min(start + batch, end))
+            if not records:
+                break
+            for record in records:
+                yield record
+            start = max(start, self.first) + len(records)
+
+    def find(self, level=None, names=None, since=None, until=None,
+             pattern=None, start=0):
+        """ Iterate over the `(number, LogRecord)` tuples of the buffered
+        messages matching all of the given criteria.
+
+        @param level: the minimum level of the messages
+        @param names: a logger name, or a list of them, of the messages.  The
+            messages of the loggers below these are included as well.
+        @param since: the earliest time of the messages, in seconds since the
+            epoch
+        @param until: the latest time of the messages
+        @param pattern: a regular expression searched for in the message and
+            its traceback
+        @param start: the number of the first message to consider
+
+        Only the messages of the requested levels, within the time range, are
+        looked at.  The messages are found a chunk at a time as the iterator
+        is consumed, so messages logged meanwhile are found as well.  Raises
+        ValueError right away for an unknown level name.
+        """
+        if isinstance(level, basestring):
+            levelno = logging.getLevelName(level.upper())
+            if not isinstance(levelno, int):
+                raise ValueError('Unknown logging level %s' % level)
+            level = levelno
+        if isinstance(names, basestring):
+            names = [names]
+        if isinstance(pattern, basestring):
+            pattern = re.compile(pattern)
+        return self._find(level, names, since, until, pattern, start)
+
+    def _find(self, level, names, since, until, pattern, start):
+        """ Iterate over the matches of `find()`, once its arguments are
+        checked """
+        # Whether each site matches the level and names, extended as sites
+        # are added
+        site_matches = []
+
+        pos = start
+        while True:
+            matches = []
+            self.acquire()
+            try:
+                for site in self.sites[len(site_matches):]:
+                    site_matches.append(
+                        (level is None or site[3] >= level) and
+                        (not names or bool([name for name in names
+                                            if site[0] == name or
+                                            site[0].startswith(name + '.')])))
+                base = self.first - self.offset
+                pos = max(pos, self.first)
+                if pos >= self.get_length():
+                    break
+                chunk_start = pos - (pos - base) % _Chunk.size
+                chunk = self.chunks[(pos - base) // _Chunk.size]
+                next_pos = chunk_start + len(chunk.args)
+                if (since is None or chunk.max_created >= since) and \
+                   (until is None or chunk.min_created <= until):
+                    lo = pos - chunk_start
+                    if level is None:
+                        positions = xrange(lo, len(chunk.args))
+                    else:
+                        positions = merge(*[
+                            positions[bisect_left(positions, lo):]
+                            for levelno, positions in chunk.levels.items()
+                            if levelno >= level])
+                    for index in positions:
+                        created = chunk.created[index]
+                        if since is not None and created < since or \
+                           until is not None and created > until or \
+                           not site_matches[chunk.sites[index]]:
+                            continue
+                        if pattern and not self._search(pattern, chunk, index):
+                            continue
+                        matches.append((chunk_start + index,
+                                        self._get_record(chunk_start + index -
+                                                         self.first)))
+            finally:
+                self.release()
+            for match in matches:
+                yield match
+            pos = next_pos
+
+    def _search(self, pattern, chunk, index):
+        """ Return whether the message at `index` of `chunk`, or its
+        traceback, matches `pattern`, without building its `LogRecord`. """
+        msg = self.sites[chunk.sites[index]][1]
+        message = chunk.args[index]
+        if msg is not None:
+            # As in LogRecord.getMessage()
+            if not isinstance(msg, basestring):
+                msg = str(msg)
+            try:
+                message = msg % message
+            except (TypeError, ValueError):
+                message = msg
+        if pattern.search(message):
+            return True
+        exc_text = chunk.exc_text and chunk.exc_text.get(index)
+        return bool(exc_text and pattern.search(exc_text))
+
+    def save(self, filename, start=0, end=-1, compress=None):
+        """ Write the given messages to `filename`.
+
+        The messages are formatted and written a batch at a time, rather than
+        as a single string.  See `open_log_file()` for `compress`.  Returns
+        the number of messages written.
+        """
+        count = 0
+        fileobj = open_log_file(filename, 'wb', compress)
+        try:
+            lines = []
+            for record in self.iter_records(start, end):
+                lines.append(_encode(self.format(record)))
+                lines.append('\n')
+                count += 1
+                if len(lines) >= 2 * _SAVE_BATCH:
+                    fileobj.write(''.join(lines))
+                    lines = []
+            fileobj.write(''.join(lines))
+        finally:
+            fileobj.close()
+        return count
+
+    def get_lines(self, start=0, end=-1):
+        """ Return the formatted lines of the given messages """
+        lines = []
+        for record in self.get_records(start, end):
+            lines.extend(self.format(record).split('\n'))
+        return lines
 
     def clear_log(self):
-        self.buffer = []
+        self.acquire()
+        try:
+            self.chunks = [_Chunk()]
+            self.sites = []
+            self.site_ids = {}
+            self.offset = 0
+            self.count = 0
+            self.first = 0
+            self.size = 0
+        finally:
+            self.release()
+
+    def close(self):
+        if self.spill:
+            self.spill.close()
+        logging.Handler.close(self)
+
+    def format(self, record):
+        """ Format a message, without failing on one that the formatter
+        can not handle so that the rest of the buffer can still be shown """
+        return _format(self, record)
+
+
+class BackgroundFileHandler(logging.Handler):
+    """ Log handler that appends messages to a file from a background
+    thread, so that logging never waits for the disk.
+
+    If `backlog` is given, it is a `(BufferHandler, start, end)` tuple of
+    buffered messages that are written to the file before the ones logged
+    to this handler.  See `open_log_file()` for `compress`.
+    """
+    def __init__(self, filename, compress=None, backlog=None,
+                 level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self.filename = filename
+        self.backlog = backlog
+        self.queue = Queue.Queue()
+        self.fileobj = open_log_file(filename, 'wb', compress)
+        self.thread = threading.Thread(target=self._run,
+                                       name='dustbowl-log-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        """ Queue the message to be written """
+        try:
+            # Format the message now, as its arguments may change.  The
+            # record is shared with the other handlers, so a copy is queued.
+            copy = logging.makeLogRecord(record.__dict__)
+            if copy.exc_info and not copy.exc_text:
+                formatter = self.formatter or logging._defaultFormatter
+                copy.exc_text = formatter.formatException(copy.exc_info)
+            copy.msg = copy.getMessage()
+            copy.args = None
+            copy.exc_info = None
+            self.queue.put(copy)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    #noinspection PyBroadException
+    def _run(self):
+        if self.backlog:
+            hndlr, start, end = self.backlog
+            self.backlog = None
+            lines = []
+            for record in hndlr.iter_records(start, end):
+                lines.append(_encode(self.format(record)))
+                lines.append('\n')
+                if len(lines) >= 2 * _SAVE_BATCH:
+                    self._write(lines)
+                    lines = []
+            self._write(lines)
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            lines = [_encode(self.format(record)), '\n']
+            # Write whatever else is already waiting in one go
+            try:
+                while len(lines) < 2 * _SAVE_BATCH:
+                    record = self.queue.get_nowait()
+                    if record is None:
+                        self.queue.put(None)
+                        break
+                    lines.append(_encode(self.format(record)))
+                    lines.append('\n')
+            except Queue.Empty:
+                pass
+            self._write(lines)
+            if self.queue.empty():
+                self.fileobj.flush()
+        self.fileobj.close()
+
+    #noinspection PyBroadException
+    def _write(self, lines):
+        try:
+            self.fileobj.write(''.join(lines))
+        except:
+            sys.stderr.write('Unable to write the log to %s\n' % self.filename)
+
+    def close(self):
+        """ Write the queued messages and close the file """
+        if self.thread:
+            self.queue.put(None)
+            if self.thread is not threading.currentThread():
+                self.thread.join()
+            self.thread = None
+        logging.Handler.close(self)
+
+    def format(self, record):
+        """ Format a message, without stopping the writer thread on one
+        that the formatter can not handle """
+        return _format(self, record)
 
 
-def get_logger(logname='dustbowl', level=logging.DEBUG, format=''):
+def get_logger(logname='dustbowl', level=logging.DEBUG, format='',
+               max_records=0, max_bytes=0, spill=''):
     logger = logging.getLogger(logname)
     logger.setLevel(level)
-    hndlr = BufferHandler()
+    hndlr = BufferHandler(max_records=max_records, max_bytes=max_bytes,
+                          spill=spill)
     if format:
         fmt = logging.Formatter(format)
         hndlr.setFormatter(fmt)
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2009 John Hampton <pacopablo@pacopablo.com>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# Author: John Hampton <pacopablo@pacopablo.com>
+
+# Standard Library Imports
+import heapq
+import itertools
+import sys
+import thread
+import threading
+import time
+import traceback
+from collections import deque
+from functools import wraps
+from inspect import isgenerator
+
+# Third Party Imports
+
+# Local Imports
+from dustbowl.jobs import Job, JobCancelled, RUNNING, DONE, FAILED, CANCELLED
+
+__all__ = [
+    'EventLoop',
+    'Task',
+    'Return',
+    'Coroutine',
+    'coroutine',
+]
+
+
+class Return(Exception):
+    """ Raised by a coroutine to return a value.
+
+    A generator can not ``return`` a value, so a coroutine ends with
+    ``raise Return(value)`` instead.
+    """
+
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+class Coroutine(object):
+    """ The generator returned by a function decorated with `coroutine`,
+    marked as meant to be run by an `EventLoop`. """
+    __slots__ = ('gen',)
+
+    def __init__(self, gen):
+        self.gen = gen
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__,
+                            getattr(self.gen, '__name__', self.gen))
+
+
+def coroutine(func):
+    """ Decorator marking a generator function as a coroutine.
+
+    A command provider returns such a coroutine from `run()` to have it run
+    by the event loop of the console; any other value, including a plain
+    generator, is left alone.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        return Coroutine(func(*args, **kwargs))
+    return wrapper
+
+
+class Task(Job):
+    """ A coroutine run by an `EventLoop`.
+
+    The coroutine is a generator, which is resumed each time the value it
+    yields is ready:
+
+     * ``None`` resumes it on the next pass of the loop
+     * a number of seconds resumes it after that long
+     * a generator or `Coroutine` is run as a task of its own, and a
+       `Task` or `dustbowl.jobs.Job` is waited for; the coroutine is resumed
+       with the result, or has the error raised where it yielded
+
+    A task is a `dustbowl.jobs.Job`, so that it can be listed and waited
+    for along with the background jobs of the console.
+    """
+
+    def __init__(self, id, source, coro, loop):
+        Job.__init__(self, id, source, None)
+        self.coro = coro
+        self.loop = loop
+        # Number of the wakeup the task waits for, so that the wakeup of a
+        # sleep or task interrupted by a cancellation is ignored
+        self._wakeup = 0
+        self._waiting = None
+
+    def cancel(self):
+        """ Cancel the task, by raising `JobCancelled` where the coroutine
+        yielded.  A task it waits for is cancelled as well.  Returns False if
+        the task has finished already. """
+        if self.done():
+            return False
+        self.loop.call_soon(self._cancel)
+        return True
+
+    def _cancel(self):
+        if self.done():
+            return
+        if isinstance(self._waiting, Task):
+            self._waiting.cancel()
+        self._schedule(0, None, JobCancelled())
+
+    #noinspection PyBroadException
+    def _step(self, wakeup, value=None, exc=None):
+        """ Resume the coroutine.  Only called in the thread of the loop. """
+        if self.done() or wakeup != self._wakeup:
+            return
+        self._waiting = None
+        if self.status != RUNNING:
+            self.status = RUNNING
+            self.started = time.time()
+        try:
+            if exc is not None:
+                yielded = self.coro.throw(exc)
+            else:
+                yielded = self.coro.send(value)
+        except StopIteration:
+            self._end(DONE)
+        except Return, e:
+            self.result = e.value
+            self._end(DONE)
+        except JobCancelled:
+            self._end(CANCELLED)
+        except:
+            exc_type, self.exception, tb = sys.exc_info()
+            # Leave this frame out of the traceback
+            self.error = ''.join(traceback.format_exception(
+                                    exc_type, self.exception, tb.tb_next))
+            del tb
+            self._end(FAILED)
+        else:
+            self._wait_for(yielded)
+
+    def _wait_for(self, yielded):
+        if yielded is None:
+            self._schedule(0)
+        elif isinstance(yielded, (int, long, float)):
+            self._schedule(yielded)
+        else:
+            if isgenerator(yielded) or isinstance(yielded, Coroutine):
+                yielded = self.loop.create_task(yielded, self.source)
+            if isinstance(yielded, Job):
+                self._waiting = yielded
+                self._wakeup += 1
+                wakeup = self._wakeup
+                yielded.add_done_callback(lambda job:
+                        self.loop.call_soon(self._resume, wakeup, job))
+            else:
+                self._schedule(0, None,
+                               TypeError('Can not wait for %r' % (yielded,)))
+
+    def _resume(self, wakeup, job):
+        if job.status == DONE:
+            self._step(wakeup, job.result)
+        elif job.status == FAILED:
+            self._step(wakeup, None, job.exception)
+        else:
+            self._step(wakeup, None, JobCancelled())
+
+    def _schedule(self, delay, value=None, exc=None):
+        self._wakeup += 1
+        if delay > 0:
+            self.loop.call_later(delay, self._step, self._wakeup, value, exc)
+        else:
+            self.loop.call_soon(self._step, self._wakeup, value, exc)
+
+    def _end(self, status):
+        with self._lock:
+            self._finish(status)
+        self.coro = None
+        self._run_callbacks()
+
+
+class EventLoop(object):
+    """ Runs callbacks and coroutines in a thread of its own.
+
+    The loop keeps running in the background once started, so tasks make
+    progress between prompts.  Callbacks may be scheduled from any thread.
+    """
+
+    def __init__(self, log=None):
+        self.log = log
+        self._ready = deque()
+        # Heap of (time, sequence, callback, arguments)
+        self._timers = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._thread_id = None
+        self._running = False
+
+    def __repr__(self):
+        return '<%s %s, %d callbacks and %d timers pending>' % \
+               (self.__class__.__name__,
+                self._running and 'running' or 'stopped',
+                len(self._ready), len(self._timers))
+
+    def start(self):
+        """ Start running the loop in a daemon thread """
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run,
+                                            name='dustbowl-loop')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """ Stop the loop once the callbacks being run have returned """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread and self._thread is not threading.currentThread():
+            self._thread.join()
+        self._thread = None
+
+    def in_loop_thread(self):
+        return self._thread_id == thread.get_ident()
+
+    def call_soon(self, func, *args):
+        """ Call `func` with `args` on the next pass of the loop """
+        with self._cond:
+            self._ready.append((func, args))
+            self._cond.notify()
+
+    def call_later(self, delay, func, *args):
+        """ Call `func` with `args` after `delay` seconds """
+        with self._cond:
+            heapq.heappush(self._timers, (time.time() + delay,
+                                          self._sequence.next(), func, args))
+            self._cond.notify()
+
+    def create_task(self, coro, source=None):
+        """ Schedule the coroutine `coro`, a generator or `Coroutine`, and
+        return its `Task` """
+        if isinstance(coro, Coroutine):
+            coro = coro.gen
+        task = Task(0, source or repr(coro), coro, self)
+        task._schedule(0)
+        return task
+
+    #noinspection PyBroadException
+    def _run(self):
+        self._thread_id = thread.get_ident()
+        while True:
+            with self._cond:
+                while self._running and not self._ready:
+                    timeout = None
+                    if self._timers:
+                        timeout = self._timers[0][0] - time.time()
+                        if timeout <= 0:
+                            break
+                    self._cond.wait(timeout)
+                if not self._running:
+                    break
+                now = time.time()
+                while self._timers and self._timers[0][0] <= now:
+                    self._ready.append(heapq.heappop(self._timers)[2:])
+                ready = self._ready
+                self._ready = deque()
+            for func, args in ready:
+                try:
+                    func(*args)
+                except:
+                    if self.log:
+                        self.log.error('Error in event loop callback %r',
+                                       func, exc_info=True)
+                continue
+        self._thread_id = None
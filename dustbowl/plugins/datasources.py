@@ -62,8 +62,8 @@ class DataSourceManager(Component):
         try:
             ret = sources[datasource][part]
         except KeyError:
-            self.log.warning('The datasource >> %s << was not found' %
-                             str(datasource))
+            self.log.warning('The datasource >> %s << was not found',
+                             datasource)
             ret = None
         return ret
 
@@ -10,11 +10,15 @@
 
 # Standard Library Imports
 import logging
+import time
+from datetime import datetime
+from itertools import islice
 
 # Third Party Imports
 
 # Local Imports
 from dustbowl.api import IShellCommandProvider, Component, implements
+from dustbowl.log import BackgroundFileHandler
 
 __all__ = [
     'LogCmdProvider',
@@ -27,25 +31,54 @@ class LogCmdProvider(Component):
     The log command requires one of the following arguements:
      * show
      * save
+     * grep
+     * filter
+     * more
      * clear
 
     show:  Will show all unread log messages.  If passed the 'all' parameter, all
            log message with be shown regardless of read status.
     save:  Must be passed the name of a file.  The log will be saved to the
            specified file.  The file will be overwritten if it already exists.
+           The file is compressed with gzip if its name ends with '.gz', or
+           if passed compress=True.  With the 'follow' parameter, messages
+           logged afterwards are also appended to the file, from a
+           background thread, until '.log.save.stop' is run.
+    grep:  Must be passed a regular expression.  Shows the log messages
+           matching it, a page at a time.  Accepts the same keyword
+           arguments as filter.
+    filter: Shows the log messages matching all of the given keyword
+           arguments, a page at a time:  level (the minimum level), name (a
+           logger name, or a list of them), since and until (a time such as
+           '12:30', '2009-06-01 12:30:00', a datetime or seconds since the
+           epoch) and pattern (a regular expression).
+    more:  Shows the next page of messages of the last grep or filter.
     clear: Clears the log.
 
     Examples:
      1) >>> .log.show
      1) >>> .log.show.all
      1) >>> .log.save 'logfile.log'
+     1) >>> .log.save.follow 'logfile.log.gz'
+     1) >>> .log.save.stop
+     1) >>> .log.grep 'timeout', level='WARNING'
+     1) >>> .log.filter name='sqlalchemy', since='12:30'
+     1) >>> .log.more
      1) >>> .log.clear
     """
 
+    page_size = 50
+
     implements(IShellCommandProvider)
 
     def __init__(self):
         self.level = self.log.getEffectiveLevel()
+        self.writers = {}
+        self.matches = None
+        self.next_match = None
+
+    def get_command_prefixes(self):
+        yield 'log'
 
     def match(self, cmd):
         c = cmd.lower()
@@ -85,22 +118,139 @@ class LogCmdProvider(Component):
         shown, regardless of whether it has been seen previously.
         """
         startidx = getattr(self, 'startidx', 0)
-        length = self.log._buffer_hndlr.get_length()
+        hndlr = self.log._buffer_hndlr
+        length = hndlr.get_length()
 
         cmds = cmd.split('.')
         showall = cmds[2:3]
         if not showall:
-            text = '\n  '.join(self.log._buffer_hndlr.get_lines(startidx))
+            # Messages may have been evicted from a bounded buffer since the
+            # last time the log was shown
+            first = hndlr.get_first()
+            if startidx < first:
+                spill = hndlr.spill
+                print('  (%d unread messages were evicted from the buffer%s)' %
+                      (first - startidx,
+                       spill and ', see %s' % spill.baseFilename or ''))
+            text = '\n  '.join(hndlr.get_lines(startidx))
         elif showall[0].lower() == 'all':
-            text = '\n  '.join(self.log._buffer_hndlr.get_lines())
+            text = '\n  '.join(hndlr.get_lines())
         else:
             text = '\n'
         print('  ' + text)
         self.startidx = length
         return False
 
-    def _log_save(self, *args, **kwargs):
-        print('Not Implemented yet')
+    def _log_save(self, cmd, *args, **kwargs):
+        """ Save the log to a file.
+
+        When invoked as .log.save.follow, messages logged afterwards are
+        appended to the file as well, until .log.save.stop is invoked with
+        the name of the file, or without arguments to stop all such files.
+        """
+        cmds = cmd.split('.')
+        mode = cmds[2:3] and cmds[2].lower() or ''
+        hndlr = self.log._buffer_hndlr
+        if mode == 'stop':
+            for filename in args or self.writers.keys():
+                writer = self.writers.pop(filename, None)
+                if writer:
+                    self.log.removeHandler(writer)
+                    writer.close()
+                    print('Stopped saving the log to %s' % filename)
+                else:
+                    print('The log is not being saved to %s' % filename)
+            return False
+        if len(args) != 1 or mode not in ('', 'follow'):
+            print("Usage: .log.save 'file' or .log.save.follow 'file'")
+            return False
+
+        filename = args[0]
+        compress = kwargs.get('compress')
+        try:
+            if mode == 'follow':
+                if filename in self.writers:
+                    print('The log is already being saved to %s' % filename)
+                    return False
+                # Attach the writer while holding the buffer lock, so that
+                # each message is either in the backlog or sent to the writer
+                hndlr.acquire()
+                try:
+                    writer = BackgroundFileHandler(filename, compress,
+                                    (hndlr, 0, hndlr.get_length()))
+                    writer.setFormatter(hndlr.formatter)
+                    self.log.addHandler(writer)
+                finally:
+                    hndlr.release()
+                self.writers[filename] = writer
+                print('Saving the log to %s in the background' % filename)
+            else:
+                count = hndlr.save(filename, compress=compress)
+                print('Saved %d messages to %s' % (count, filename))
+        except (IOError, OSError), e:
+            print('Unable to save the log to %s: %s' % (filename, e))
+        return False
+
+    def _log_grep(self, cmd, *args, **kwargs):
+        """ Show the log messages matching a regular expression """
+        if len(args) != 1:
+            print("Usage: .log.grep 'regex'[, level=..., name=..., since=..., "
+                  "until=...]")
+            return False
+        kwargs['pattern'] = args[0]
+        return self._log_filter(cmd, **kwargs)
+
+    def _log_filter(self, cmd, *args, **kwargs):
+        """ Show the log messages matching the given criteria """
+        unknown = set(kwargs) - set(['level', 'name', 'since', 'until',
+                                     'pattern', 'page_size'])
+        if args or unknown:
+            print("Usage: .log.filter level=..., name=..., since=..., "
+                  "until=..., pattern=...")
+            return False
+        level = kwargs.get('level')
+        if isinstance(level, basestring) and \
+           level.upper() not in logging._levelNames:
+            print("Unknown logging level %s.  Use DEBUG, INFO, WARNING, "
+                  "ERROR, or CRITICAL." % level)
+            return False
+        try:
+            since = _parse_time(kwargs.get('since'))
+            until = _parse_time(kwargs.get('until'))
+            self.matches = self.log._buffer_hndlr.find(level,
+                                                       kwargs.get('name'),
+                                                       since, until,
+                                                       kwargs.get('pattern'))
+            self.next_match = None
+            self.page_size = kwargs.get('page_size', self.page_size)
+            return self._log_more(cmd)
+        except Exception, e:
+            self.matches = None
+            print('Invalid filter: %s' % e)
+        return False
+
+    def _log_more(self, *args, **kwargs):
+        """ Show the next page of messages of the last grep or filter """
+        if self.matches is None:
+            print('No more messages')
+            return False
+        hndlr = self.log._buffer_hndlr
+        page = self.next_match and [self.next_match] or []
+        page.extend(islice(self.matches, self.page_size + 1 - len(page)))
+        self.next_match = None
+        lines = []
+        for number, record in page[:self.page_size]:
+            lines.extend(hndlr.format(record).split('\n'))
+        if lines:
+            print('  ' + '\n  '.join(lines))
+        if len(page) > self.page_size:
+            # Keep the message used to tell whether there are more
+            self.next_match = page[-1]
+            print('-- More: .log.more --')
+        else:
+            self.matches = None
+            if not page:
+                print('No matching messages')
         return False
 
     def _log_clear(self, *args, **kwargs):
@@ -108,3 +258,26 @@ class LogCmdProvider(Component):
         self.startidx = 0
         print('Log Cleared')
         return False
+
+
+def _parse_time(value):
+    """ Return a time given as accepted by .log.filter in seconds since
+    the epoch. """
+    if value is None or isinstance(value, (int, long, float)):
+        return value
+    if isinstance(value, datetime):
+        return time.mktime(value.timetuple()) + value.microsecond / 1e6
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            continue
+    for fmt in ('%H:%M:%S', '%H:%M'):
+        try:
+            parsed = time.strptime(value, fmt)
+        except ValueError:
+            continue
+        # A time of day is taken to be today
+        today = time.localtime()
+        return time.mktime(today[:3] + parsed[3:6] + today[6:])
+    raise ValueError('Unknown time format: %r' % value)
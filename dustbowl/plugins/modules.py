@@ -50,6 +50,9 @@ class ModuleCmdProvider(Component):
 
     implements(IShellCommandProvider)
 
+    def get_command_prefixes(self):
+        yield 'module'
+
     def match(self, cmd):
         c = cmd.lower()
         return c == 'module' or c.startswith('module.')
@@ -61,7 +64,7 @@ class ModuleCmdProvider(Component):
             cmd = 'list'
         else:
             cmd = cmds[1]
-        self.log.debug('ModuleCmdProvider: num_cmds = %d' % num_cmds)
+        self.log.debug('ModuleCmdProvider: num_cmds = %d', num_cmds)
         f = getattr(self, '_module_%s' % cmd, None)
         if f:
             f(cmd, *args, **kwargs)
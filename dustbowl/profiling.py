@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2009 John Hampton <pacopablo@pacopablo.com>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# Author: John Hampton <pacopablo@pacopablo.com>
+
+# Standard Library Imports
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+# Third Party Imports
+
+# Local Imports
+
+
+__all__ = [
+    'StartupProfiler',
+    'NullProfiler',
+    'get_memory_usage',
+]
+
+
+def get_memory_usage():
+    """ Return the resident memory of the process in bytes, or ``None`` if it
+    can not be determined.
+    """
+    try:
+        fileobj = open('/proc/self/statm')
+        try:
+            return int(fileobj.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        finally:
+            fileobj.close()
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Peak rather than current usage, but good enough to spot big allocations
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return usage
+    return usage * 1024
+
+
+class NullProfiler(object):
+    """ Profiler that records nothing """
+
+    @contextmanager
+    def phase(self, name, kind='phase'):
+        yield
+
+
+class StartupProfiler(object):
+    """ Records the wall time and memory used by the phases of the startup.
+
+    Phases may be nested, in which case the time of the inner phase is also
+    included in the time of the outer phase.
+    """
+
+    def __init__(self):
+        self.records = []
+        self.started = time.time()
+
+    @contextmanager
+    def phase(self, name, kind='phase'):
+        """ Record the time and memory used by the enclosed block. """
+        mem_start = get_memory_usage()
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            mem_end = get_memory_usage()
+            memory = None
+            if mem_start is not None and mem_end is not None:
+                memory = mem_end - mem_start
+            self.records.append({
+                'name' : name,
+                'kind' : kind,
+                'time' : elapsed,
+                'memory' : memory,
+            })
+
+    def report(self, stream=None):
+        """ Write a table of the recorded phases, slowest first. """
+        stream = stream or sys.stdout
+        stream.write('%-50s %-10s %10s %12s\n' %
+                     ('Phase', 'Kind', 'Time (ms)', 'Memory (KB)'))
+        records = sorted(self.records, key=lambda r: r['time'], reverse=True)
+        for record in records:
+            memory = record['memory']
+            memory = memory is not None and '%d' % (memory / 1024) or '-'
+            stream.write('%-50s %-10s %10.2f %12s\n' %
+                         (record['name'][:50], record['kind'],
+                          record['time'] * 1000, memory))
+        stream.write('Total startup time: %.2f ms\n' %
+                     ((time.time() - self.started) * 1000))
+
+    def save(self, filename):
+        """ Write the recorded phases to `filename` as JSON. """
+        import json
+        data = {
+            'started' : self.started,
+            'total' : time.time() - self.started,
+            'python' : sys.version.split()[0],
+            'phases' : self.records,
+        }
+        fileobj = open(filename, 'w')
+        try:
+            json.dump(data, fileobj, indent=2, sort_keys=True)
+        finally:
+            fileobj.close()
@@ -9,7 +9,14 @@
 # Author: John Hampton <pacopablo@pacopablo.com>
 
 # Standard library imports
+import re
 import sys
+import time
+import tokenize
+from keyword import iskeyword
+from StringIO import StringIO
+from functools import partial
+from inspect import isgenerator
 from code import InteractiveConsole, compile_command
 
 # Third Party imports
@@ -18,11 +25,83 @@ from colorama import Fore, Style
 
 # Local imports
 import dustbowl.env
+from dustbowl.jobs import Job, JobCancelled, JobManager, DONE, FAILED
+from dustbowl.loop import Coroutine, EventLoop
+from dustbowl.util import LRUCache
 
 VERSION = '1.0.1'
 
 CMD_TOKEN = "."
 
+# A line holding nothing but a dot-command and its arguments
+COMMAND_RE = re.compile(r'^\s*%s([A-Za-z_][\w.]*)(?:\s+(.*?))?\s*$' %
+                        re.escape(CMD_TOKEN))
+
+# Job control commands, handled by the console itself as `.bg` takes source
+# rather than arguments
+JOB_COMMAND_RE = re.compile(r'^\s*%s(bg|jobs|fg|cancel)(?:\s+(.*?))?\s*$' %
+                            re.escape(CMD_TOKEN))
+
+# Default number of compiled lines kept by `DustbowlConsole`
+CODE_CACHE_SIZE = 500
+
+# Default number of threads running background jobs
+JOB_WORKERS = 4
+
+
+def _command_args(*args, **kwargs):
+    return args, kwargs
+
+
+def _split_await(line):
+    """ Split a line of the form ``[target =] await <expression>`` into its
+    indentation, target and expression, or return ``None``.
+
+    `await` is only recognized as the first name of the line, or right after
+    the ``=`` of a simple assignment, when followed by something that could
+    not follow a name in Python, so that it can still be used as a name.  The
+    expression may be a dot-command.
+    """
+    tokens = []
+    try:
+        for token in tokenize.generate_tokens(StringIO(line).readline):
+            if token[0] in (tokenize.COMMENT, tokenize.NL, tokenize.NEWLINE,
+                            tokenize.ENDMARKER):
+                break
+            if token[0] not in (tokenize.INDENT, tokenize.DEDENT):
+                tokens.append(token)
+    except (tokenize.TokenError, IndentationError):
+        # An incomplete line, continued by the next ones
+        return None
+
+    pos = 0
+    depth = 0
+    for index, (kind, text, start, end, _) in enumerate(tokens):
+        if text in ('(', '[', '{'):
+            depth += 1
+        elif text in (')', ']', '}'):
+            depth -= 1
+        elif kind == tokenize.OP and text == '=' and not depth:
+            pos = index + 1
+            break
+    if pos + 1 >= len(tokens) or tokens[pos][1] != 'await':
+        return None
+    kind, text, start, end, _ = tokens[pos + 1]
+    if kind == tokenize.OP and text == CMD_TOKEN:
+        # A dot-command, told apart from an attribute by the space before it
+        if start[1] == tokens[pos][3][1] or pos + 2 >= len(tokens) or \
+           tokens[pos + 2][0] != tokenize.NAME:
+            return None
+    elif not (kind in (tokenize.NUMBER, tokenize.STRING) or
+              kind == tokenize.NAME and not iskeyword(text)):
+        return None
+    indent = line[:len(line) - len(line.lstrip())]
+    target = None
+    if pos:
+        target = line[tokens[0][2][1]:tokens[pos - 1][2][1]].strip()
+    return indent, target, line[start[1]:tokens[-1][3][1]]
+
+
 class DustbowlConsole(InteractiveConsole):
 
     def __init__(self, locals=None, filename="<console>", args=None, logger=None):
@@ -33,8 +112,29 @@ class DustbowlConsole(InteractiveConsole):
                                           'dustbowl.modules',
                                           args.plugins,
                                           logger,
-                                          self.locals)
+                                          self.locals,
+                                          getattr(args, 'plugin_cache', None),
+                                          getattr(args, 'rescan_plugins',
+                                                  False),
+                                          getattr(args, 'profiler', None))
         self.locals['__env__'] = self.env
+        # Compiled console input and dot-command arguments, exposed in the
+        # console so that its hit rate can be checked
+        self.code_cache = LRUCache(getattr(args, 'code_cache_size',
+                                           CODE_CACHE_SIZE))
+        self.locals['_code_cache'] = self.code_cache
+        # Number of errors shown to the user
+        self.errors = 0
+        self.jobs = JobManager(getattr(args, 'job_workers', JOB_WORKERS),
+                               logger)
+        self.locals['_jobs'] = self.jobs
+        self.loop = None
+        if getattr(args, 'event_loop', False):
+            self.loop = EventLoop(logger)
+            self.loop.start()
+            self.locals['_loop'] = self.loop
+            self.locals['__await__'] = self.await_value
+            self.env.schedule_coroutine = self.start_task
 
     def interact(self, banner=None):
         global CMD_TOKEN
@@ -61,6 +161,9 @@ class DustbowlConsole(InteractiveConsole):
             if i['loaded']:
                 self.write(Style.DIM + "Loaded %s\n" % i['entry'].name +
                            Style.NORMAL)
+            elif i.get('deferred'):
+                self.write(Style.DIM + "Deferred %s\n" % i['entry'].name +
+                           Style.NORMAL)
         if 'readline' in sys.modules:
             self.write("Dustbowl Tabbed Completion Enabled\n")
 
@@ -71,6 +174,7 @@ class DustbowlConsole(InteractiveConsole):
                     prompt = sys.ps2
                 else:
                     prompt = sys.ps1
+                    self.report_jobs()
                 try:
                     line = self.raw_input(prompt)
                     # Can be None if sys.stdin was redefined
@@ -81,14 +185,276 @@ class DustbowlConsole(InteractiveConsole):
                     self.write("\n")
                     break
                 else:
-                    if line.strip().startswith(CMD_TOKEN):
-                        line = self.process_command(line)
-                    more = self.push(line)
+                    more = self.push_line(line, more)
             except KeyboardInterrupt:
                 self.write("\nKeyboardInterrupt\n")
                 self.resetbuffer()
                 more = 0
 
+    def push_line(self, line, more=False):
+        """ Push a line of input, which may be a dot-command.
+
+        `more` tells whether the line continues the previous ones.  Returns
+        whether more input is required, as `push()` does.
+        """
+        if self.loop and not more:
+            line = self.rewrite_await(line)
+        if line.strip().startswith(CMD_TOKEN):
+            if not more and (self.run_job_command(line) or
+                             self.run_command(line)):
+                return False
+            line = self.process_command(line)
+        return self.push(line)
+
+    def run_job_command(self, line):
+        """ Run a job control command.
+
+        ``.bg <source>`` runs a line of Python, or a dot-command, in a
+        background thread.  ``.jobs`` lists the jobs, ``.fg [N]`` waits for a
+        job, the last one by default, and shows its result, and
+        ``.cancel N`` cancels a job.  Jobs are also available in the console
+        as `_jobs`, so that for instance ``_jobs[1].result`` is the value of
+        the first job.
+
+        Returns False if the line is not a job control command.
+        """
+        match = JOB_COMMAND_RE.match(line)
+        if not match:
+            return False
+        cmd, source = match.groups()
+        if cmd == 'bg':
+            self.start_job(source)
+        elif cmd == 'jobs':
+            for job in self.jobs:
+                self.write('[%d] %-20s %s\n' % (job.id, job.describe(),
+                                                 job.source))
+        else:
+            job = self._find_job(source, cmd == 'fg')
+            if job and cmd == 'cancel':
+                if not job.cancel():
+                    self.write('Job %d can not be cancelled\n' % job.id)
+            elif job:
+                self.wait_job(job)
+        return True
+
+    def start_job(self, source):
+        """ Compile `source` and run it as a background job """
+        if not source:
+            self.write('Usage: .bg <expression, statement or command>\n')
+            return None
+        code_source = source
+        if source.startswith(CMD_TOKEN):
+            code_source = self.process_command(source)
+        try:
+            try:
+                code = compile(code_source, '<job>', 'eval')
+            except SyntaxError:
+                code = compile(code_source, '<job>', 'exec')
+        except (OverflowError, SyntaxError, ValueError):
+            self.showsyntaxerror('<job>')
+            return None
+        job = self.jobs.submit(source, partial(eval, code, self.locals))
+        self.write('[%d] %s\n' % (job.id, source))
+        return job
+
+    def start_task(self, source, coro):
+        """ Run the coroutine `coro` as a job on the event loop """
+        task = self.jobs.add(self.loop.create_task(coro, source))
+        self.write('[%d] %s\n' % (task.id, source))
+        return task
+
+    def rewrite_await(self, line):
+        """ Rewrite a line of the form ``[target =] await <expression>``
+        to wait for the expression with `await_value()`.
+
+        The expression may be a dot-command.  Only whole lines are rewritten,
+        `await` can not be used within a block or an expression.
+        """
+        parts = _split_await(line)
+        if not parts:
+            return line
+        indent, target, source = parts
+        code_source = source
+        if source.startswith(CMD_TOKEN):
+            code_source = self.process_command(source)
+        return '%s%s__await__(%s, %r)' % (indent,
+                                          target and target + ' = ' or '',
+                                          code_source, source)
+
+    def await_value(self, value, source='<await>'):
+        """ Wait for a coroutine, task or job and return its result.
+
+        A coroutine is first started as a job.  Other values are returned as
+        they are.  Waiting can be interrupted with Ctrl-C, which leaves the
+        job running.
+        """
+        if isgenerator(value) or isinstance(value, Coroutine):
+            value = self.start_task(source, value)
+        if not isinstance(value, Job):
+            return value
+        if self.loop.in_loop_thread():
+            raise RuntimeError('Can not wait for job %d within the event '
+                               'loop, yield it instead' % value.id)
+        try:
+            # Waiting in short steps keeps the wait interruptible
+            while not value.wait(0.1):
+                pass
+        except KeyboardInterrupt:
+            self.write('Job %d left running, see .fg %d\n' % (value.id,
+                                                               value.id))
+            raise
+        if value.status == FAILED:
+            raise value.exception
+        if value.status != DONE:
+            raise JobCancelled('Job %d was cancelled' % value.id)
+        return value.result
+
+    def wait_job(self, job):
+        """ Wait for a job and show its result or error.
+
+        Waiting can be interrupted with Ctrl-C, which leaves the job running.
+        """
+        # Waiting in short steps keeps the wait interruptible
+        while not job.wait(0.1):
+            pass
+        self.jobs.pop_finished()
+        if job.status == DONE:
+            if job.result is not None:
+                sys.displayhook(job.result)
+        elif job.status == FAILED:
+            self.errors += 1
+            self.write(job.error)
+        else:
+            self.write('Job %d %s\n' % (job.id, job.status))
+
+    def report_jobs(self):
+        """ Tell about the jobs that finished since the last prompt """
+        for job in self.jobs.pop_finished():
+            self.write('[%d] %-20s %s\n' % (job.id, job.describe(),
+                                             job.source))
+
+    def _find_job(self, source, default_last):
+        if not source and default_last and len(self.jobs):
+            return list(self.jobs)[-1]
+        try:
+            return self.jobs[int(source)]
+        except (TypeError, ValueError, KeyError):
+            self.write('No such job: %s\n' % (source or ''))
+            return None
+
+    def run_batch(self, lines, filename='<batch>', timing=None):
+        """ Run lines of Python and dot-commands without prompting, as if
+        they were typed into the console.
+
+        Stops at the first statement that fails, with an exception, a syntax
+        error or a failed command, and returns False.  Returns True if every
+        statement ran.  If `timing` is given, it is a file to which the time
+        taken by each statement is written.
+        """
+        more = False
+        start = None
+        lineno = 0
+        for lineno, line in enumerate(lines, 1):
+            line = line.rstrip('\r\n')
+            if start is None:
+                if not line.strip() or line.strip().startswith('#'):
+                    continue
+                start = time.time()
+                first = (lineno, line)
+                errors = self.errors + self.env.failed_commands
+            more = self.push_line(line, more)
+            if not more:
+                if not self._end_statement(filename, first, start, errors,
+                                           timing):
+                    return False
+                start = None
+        if more:
+            # Complete a block left open at the end of the input
+            self.push_line('', more)
+            return self._end_statement(filename, first, start, errors, timing)
+        return True
+
+    def _end_statement(self, filename, first, start, errors, timing):
+        elapsed = time.time() - start
+        lineno, line = first
+        if timing:
+            timing.write('%10.2f ms  %s:%d  %s\n' %
+                         (elapsed * 1000, filename, lineno, line.strip()))
+        if self.errors + self.env.failed_commands != errors:
+            self.write('Stopped at %s:%d\n' % (filename, lineno))
+            return False
+        return True
+
+    def showsyntaxerror(self, filename=None):
+        self.errors += 1
+        InteractiveConsole.showsyntaxerror(self, filename)
+
+    def showtraceback(self):
+        self.errors += 1
+        InteractiveConsole.showtraceback(self)
+
+    def run_command(self, line):
+        """ Run a line consisting of a single dot-command by calling the
+        environment directly.
+
+        Only the arguments of the command, if any, are compiled, and their
+        compiled form is kept in the code cache.
+        Returns False, without running anything, if the line is not such a
+        command or its arguments do not compile, in which case it is to be
+        rewritten with `process_command()` and pushed as source.
+        """
+        match = COMMAND_RE.match(line)
+        if not match:
+            return False
+        cmd, source = match.groups()
+        args, kwargs = (), {}
+        if source:
+            key = (source, 'command')
+            code = self.code_cache.get(key)
+            if code is None:
+                try:
+                    code = compile('__command_args__(%s)' % source,
+                                   self.filename, 'eval')
+                except SyntaxError:
+                    # Let the source path report the error, or wait for more
+                    # input if the arguments continue on the next line
+                    return False
+                self.code_cache.put(key, code)
+            try:
+                args, kwargs = eval(code, self.locals,
+                                    {'__command_args__': _command_args})
+            except SystemExit:
+                raise
+            except:
+                self.showtraceback()
+                return True
+        self.env(cmd, *args, **kwargs)
+        return True
+
+    def runsource(self, source, filename="<input>", symbol="single"):
+        """ Compile and run some source in the interpreter.
+
+        Behaves as `InteractiveConsole.runsource()`, except that the
+        compiled code is kept in the code cache and reused when the same
+        source is entered again.
+        """
+        # The flags of the __future__ statements seen so far change how the
+        # source compiles
+        key = (source, filename, symbol, self.compile.compiler.flags)
+        code = self.code_cache.get(key)
+        if code is None:
+            try:
+                code = self.compile(source, filename, symbol)
+            except (OverflowError, SyntaxError, ValueError):
+                self.showsyntaxerror(filename)
+                return False
+            if code is None:
+                # More input is required
+                return True
+            self.code_cache.put(key, code)
+        self.runcode(code)
+        return False
+
     def process_command(self, line):
         global CMD_TOKEN
         pos = line.find(CMD_TOKEN)
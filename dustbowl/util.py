@@ -28,6 +28,7 @@
 # Standard Library Imports
 import locale
 import traceback
+from collections import OrderedDict
 from StringIO import StringIO
 
 # Third Party Imports
@@ -38,6 +39,7 @@ __all__ = [
     'to_unicode',
     'format_exception',
     'get_last_traceback',
+    'LRUCache',
 ]
 
 def to_unicode(text, charset=None):
@@ -57,6 +59,8 @@ def to_unicode(text, charset=None):
     by using an encoding which maps each byte of the input to an unicode
     character, e.g. by doing `unicode(text, 'iso-8859-1')`.
     """
+    if isinstance(text, unicode):
+        return text
     if charset:
         return unicode(text, charset, 'replace')
     else:
@@ -77,3 +81,53 @@ def get_last_traceback():
     traceback.print_exc(file=tb)
     return tb.getvalue()
 
+
+class LRUCache(object):
+    """ Dictionary-like cache holding at most `size` entries.
+
+    When full, the least recently used entry is dropped to make room for a
+    new one.  The number of lookups that found an entry and of those that
+    did not are counted in `hits` and `misses`.  A `size` of 0 disables the
+    cache.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        # Move the entry to the most recently used end
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """ Drop every entry and reset the counters. """
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        lookups = self.hits + self.misses
+        return '<%s %d/%d entries, %d hits, %d misses (%.0f%% hit rate)>' % \
+               (self.__class__.__name__, len(self._entries), self.size,
+                self.hits, self.misses,
+                lookups and 100.0 * self.hits / lookups or 0)
@@ -29,6 +29,12 @@ setup(
         dustbowl.plugins.datasources = dustbowl.plugins.datasources
         dustbowl.plugins.config = dustbowl.plugins.config
         dustbowl.plugins.modules = dustbowl.plugins.modules
+
+        [dustbowl.console_objects]
+        get_datasource = dustbowl.plugins.datasources
+
+        [dustbowl.env_objects]
+        get_datasource = dustbowl.plugins.datasources
     """,
     long_description = """
     Dustbowl